@@ -0,0 +1,26 @@
+# the same compile benchmarks as `manage.py benchmark`, for pytest-benchmark:
+#   pytest benchmarks --benchmark-autosave
+#   pytest benchmarks --benchmark-compare --benchmark-compare-fail=median:25%
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "opyn.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+from myapp.modules.benchmarks import get_compile_benchmarks  # noqa: E402
+
+BENCHMARKS = get_compile_benchmarks()
+
+
+@pytest.mark.parametrize("benchmark_case", BENCHMARKS, ids=[benchmark.name for benchmark in BENCHMARKS])
+def test_compile(benchmark, benchmark_case):
+    benchmark(benchmark_case.fn, benchmark_case.arg)
@@ -1,3 +1,40 @@
 from django.contrib import admin
+from django.db import router
 
-# Register your models here.
+from .models import Paste
+from .modules import search
+from .pages import get_edited_pages, page_cache
+
+
+@admin.register(Paste)
+class PasteAdmin(admin.ModelAdmin):
+    list_display = ('url_name', 'creation_date', 'edited_date')
+    fields = ('url_name', 'blob', 'creation_date', 'edited_date')
+    readonly_fields = fields
+    ordering = ('-pk',)
+    show_full_result_count = False  # counting every paste gets slow
+    search_fields = ('url_name',)
+    search_help_text = "urls, and words in pastes when PASTE_SEARCH is on"
+
+    # the exact url, or every word in the content through the search index
+    def get_search_results(self, request, queryset, search_term):
+        if not search_term:
+            return queryset, False
+
+        by_url = queryset.filter(url_name=search_term)
+        if not search.is_enabled(router.db_for_read(Paste)) or not search.to_match(search_term):
+            return by_url, False
+        return by_url | queryset.filter(pk__in=search.matching(search_term)), False
+
+    # so a shared page cache doesn't keep serving them
+    def delete_model(self, request, obj):
+        super().delete_model(request, obj)
+        page_cache.invalidate(*get_edited_pages(obj.url_name, obj.url_name))
+
+    def delete_queryset(self, request, queryset):
+        paste_urls = list(queryset.values_list('url_name', flat=True))
+        super().delete_queryset(request, queryset)
+        page_cache.invalidate(*(page for url in paste_urls for page in get_edited_pages(url, url)))
+
+    def has_add_permission(self, request):
+        return False  # pastes are made through `create`, which compiles them
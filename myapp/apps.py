@@ -1,6 +1,12 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class MyappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'myapp'
+
+    def ready(self):
+        from .modules.db import apply_sqlite_pragmas, time_queries
+        connection_created.connect(apply_sqlite_pragmas)
+        connection_created.connect(time_queries)
@@ -0,0 +1,246 @@
+# async versions of the views in `views`, used instead of them when `ASYNC_VIEWS` is on.
+# templates here only ever get values which are already loaded, so rendering
+# them never touches the db and they are rendered right in the event loop
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import router
+from django.http import Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils.cache import patch_vary_headers
+
+from .models import Paste
+from .modules import search
+from .modules.pagecache import CachedPage
+from .modules.timing import request_metrics
+from .pages import (
+    RAW_FIELDS, SEARCH_PAGE_SIZE, VIEW_FIELDS, NotDeflated, aadmitted, apply_edit, cache_page,
+    check_expiry, error_page, get_edited_pages, get_gzip_view_query, get_not_modified, get_page_validators,
+    get_search_params, get_stored_validators, get_validators, gzip_response, in_chunks, new_paste, page_cache,
+    prepare_create, prepare_edit, render_around, render_gzip_view, search_response, set_validators, validate_create,
+    validate_edit, wants_gzip
+)
+
+
+# pastes which expired are gone as far as pages go
+async def _aget_paste(queryset, paste_url: str) -> Paste:
+    paste = await queryset.unexpired().filter(url_name=paste_url).afirst()
+    if paste is None:
+        raise Http404
+    return paste
+
+
+def _astream_render(request, template_name: str, context: dict, body_name: str, body) -> StreamingHttpResponse:
+    head, tail = render_around(request, template_name, context, body_name)
+
+    async def stream():
+        yield head
+        for chunk in body:
+            yield chunk
+        yield tail
+
+    return StreamingHttpResponse(stream())
+
+
+def _aconditional_paste(kind: str):
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, paste_url: str):
+            if 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers:
+                page = await page_cache.aget((kind, paste_url))
+                if page is not None:
+                    validators = check_expiry(page).etag, page.last_modified
+                else:
+                    validators = await get_page_validators(paste_url).afirst()
+                    if validators is not None:
+                        validators = get_stored_validators(kind, *validators)
+
+                if validators is not None:
+                    response = get_not_modified(request, kind, *validators)
+                    if response is not None:
+                        return response
+
+            return await view_func(request, paste_url)
+        return wrapper
+    return decorator
+
+
+async def index(request):
+    return render(request, "myapp/index.html")
+
+
+@_aconditional_paste("view")
+async def view(request, paste_url: str):
+    if wants_gzip(request):
+        async def render_gzip_page() -> CachedPage:
+            return render_gzip_view(request, paste_url, await get_gzip_view_query(paste_url).afirst())
+
+        try:
+            return gzip_response(check_expiry(
+                await page_cache.aget_or_render(("view.gz", paste_url), render_gzip_page)
+            ))
+        except NotDeflated:
+            pass
+
+    if settings.STREAM_PASTES:
+        paste = await _aget_paste(Paste.objects.select_related('blob').only(*VIEW_FIELDS), paste_url)
+        await paste.blob.arefresh_compiled()
+        response = _astream_render(request, "myapp/view.html", {
+            'current_url': paste_url
+        }, 'compiled', in_chunks(paste.blob.compiled))
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return set_validators(response, *get_validators(paste.blob_id, paste.edited_date, paste.blob.compiler_version))
+
+    async def render_page() -> CachedPage:
+        paste = await _aget_paste(Paste.objects.select_related('blob').only(*VIEW_FIELDS), paste_url)
+        await paste.blob.arefresh_compiled()
+        return cache_page(paste, paste.blob.compiler_version, render_to_string("myapp/view.html", {
+            'compiled': paste.blob.compiled,
+            'current_url': paste_url
+        }, request))
+
+    page = check_expiry(await page_cache.aget_or_render(("view", paste_url), render_page))
+    response = set_validators(HttpResponse(page.body), page.etag, page.last_modified)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
+
+
+@_aconditional_paste("raw")
+async def raw(request, paste_url: str):
+    if settings.STREAM_PASTES:
+        paste = await _aget_paste(Paste.objects.select_related('blob').only(*RAW_FIELDS), paste_url)
+        response = _astream_render(request, "myapp/raw.html", {
+            'current_url': paste_url
+        }, 'raw_markdown', in_chunks(paste.blob.content, escaped=True))
+        return set_validators(response, *get_validators(paste.blob_id, paste.edited_date, None))
+
+    async def render_page() -> CachedPage:
+        paste = await _aget_paste(Paste.objects.select_related('blob').only(*RAW_FIELDS), paste_url)
+        return cache_page(paste, None, render_to_string("myapp/raw.html", {
+            'raw_markdown': paste.blob.content,
+            'current_url': paste_url
+        }, request))
+
+    page = check_expiry(await page_cache.aget_or_render(("raw", paste_url), render_page))
+    return set_validators(HttpResponse(page.body), page.etag, page.last_modified)
+
+
+@_aconditional_paste("plain")
+async def raw_plain(request, paste_url: str):
+    paste = await Paste.objects.unexpired().filter(url_name=paste_url) \
+        .values_list('blob__content', 'blob', 'edited_date').afirst()
+    if paste is None:
+        raise Http404
+
+    content, content_hash, edited_date = paste
+    response = HttpResponse(content, content_type="text/plain; charset=utf-8")
+    return set_validators(response, *get_validators(content_hash, edited_date, None))
+
+
+@aadmitted
+async def create(request):
+    if not request.POST:  # if it is just viewing the page
+        return render(request, "myapp/create.html")
+    else:
+        # prepare
+        content, paste_url = prepare_create(request.POST)
+
+        # validate
+        error_messages = validate_create(
+            request.POST, content, paste_url, await Paste.objects.filter(url_name=paste_url).aexists()
+        )
+        if error_messages:
+            return render(request, "myapp/create.html", {
+                'content': content,
+                'paste_url': request.POST['paste_url'],
+                'expires_in': request.POST.get('expires_in', ""),
+                'error_messages': error_messages
+            })
+
+        # create the paste
+        paste = new_paste(request.POST, paste_url)
+
+        # pastes which someone else already pasted aren't compiled again
+        await paste.asave_content(content)
+
+        # redirect user to the `view` page
+        return HttpResponseRedirect(reverse("myapp:view", args=(paste_url,)))
+
+
+@aadmitted
+async def edit(request, paste_url: str):
+    if not request.POST:  # if it is just viewing the page
+        content = await Paste.objects.unexpired().filter(url_name=paste_url) \
+            .values_list('blob__content', flat=True).afirst()
+        if content is None:
+            raise Http404
+        return render(request, "myapp/edit.html", {
+            'new_content': content,
+            'current_url': paste_url
+        })
+    else:
+        paste = await _aget_paste(Paste.objects, paste_url)
+
+        # prepare
+        new_content, new_paste_url = prepare_edit(request.POST)
+
+        # validate
+        error_messages = validate_edit(
+            request.POST, paste, new_content, new_paste_url,
+            bool(new_paste_url) and await Paste.objects.filter(url_name=new_paste_url).aexists()
+        )
+        if error_messages:
+            return render(request, "myapp/edit.html", {
+                'new_content': new_content,
+                'new_paste_url': request.POST['new_paste_url'],
+                'error_messages': error_messages,
+                'current_url': paste_url
+            })
+
+        # edit the paste
+        apply_edit(request.POST, paste, new_paste_url)
+
+        await paste.asave_content(new_content)
+
+        edited_pages = get_edited_pages(paste_url, paste.url_name)
+        await page_cache.ainvalidate(*edited_pages)
+        if settings.DB_REPLICAS:
+            page_cache.invalidate_later(settings.DB_REPLICA_LAG, *edited_pages)
+
+        # redirect user to the `view` page
+        return HttpResponseRedirect(reverse("myapp:view", args=(new_paste_url if new_paste_url else paste_url,)))
+
+
+async def search_pastes(request):
+    if not settings.PASTE_SEARCH_ENDPOINT:
+        raise Http404
+
+    query, before = get_search_params(request)
+    ids = await sync_to_async(search.search)(router.db_for_read(Paste), query, before, SEARCH_PAGE_SIZE + 1)
+    return search_response(ids, [
+        paste async for paste in
+        Paste.objects.unexpired().filter(pk__in=ids).values_list('pk', 'url_name', 'creation_date', 'edited_date')
+    ])
+
+
+# histograms from `REQUEST_TIMING`, for prometheus
+async def metrics(request):
+    return HttpResponse(request_metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# error pages, only for the `status/` urls.
+# django itself can only call sync error handlers
+
+async def page_not_found(request, exception=None):
+    return error_page(request, 404)
+
+
+async def server_error(request, exception=None):
+    return error_page(request, 500)
+
+
+async def bad_request(request, exception=None):
+    return error_page(request, 400)
@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.db import models
+from django.db.models import ExpressionWrapper, F
+
+from .modules.compression import CODECS, PLAIN, compress, decompress
+
+
+# text stored compressed, as a codec byte followed by the compressed text.
+# `codec` is one of `CODECS`, by default the one in `PASTE_COMPRESSION`.
+# text shorter than `min_length` isn't worth compressing and is stored as is
+class CompressedTextField(models.BinaryField):
+    def __init__(self, *args, codec: str | None = None, min_length: int = 64, **kwargs):
+        if codec is not None and codec not in CODECS:
+            raise ValueError(f"unknown codec {codec!r}, expected one of {', '.join(CODECS)}")
+        self.codec = codec
+        self.min_length = min_length
+        kwargs.setdefault('editable', True)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        if self.codec is not None:
+            kwargs['codec'] = self.codec
+        if self.min_length != 64:
+            kwargs['min_length'] = self.min_length
+        # binary fields aren't editable by default, this one is
+        kwargs.pop('editable', None)
+        return name, path, args, kwargs
+
+    def get_codec(self) -> int:
+        return CODECS[self.codec if self.codec is not None else settings.PASTE_COMPRESSION]
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return decompress(bytes(value))
+
+    def to_python(self, value):
+        if value is None or isinstance(value, str):
+            return value
+        return decompress(bytes(value))
+
+    def get_prep_value(self, value):
+        if value is None or isinstance(value, (bytes, memoryview)):
+            return value
+        value = str(value)
+        codec = PLAIN if len(value) < self.min_length else self.get_codec()
+        return compress(value, codec, settings.PASTE_COMPRESSION_LEVEL)
+
+    def get_db_prep_value(self, value, connection, prepared=False):
+        if not prepared:
+            value = self.get_prep_value(value)
+        return super().get_db_prep_value(value, connection, prepared=True)
+
+    def value_to_string(self, obj):
+        return self.value_from_object(obj)
+
+    def formfield(self, **kwargs):
+        return models.TextField().formfield(**kwargs)
+
+
+# the value of a `CompressedTextField` as it is stored, without decompressing it
+def stored(field_name: str) -> ExpressionWrapper:
+    return ExpressionWrapper(F(field_name), output_field=models.BinaryField())
@@ -0,0 +1,126 @@
+from itertools import count
+
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+from myapp import pages
+from myapp.modules.benchmarks import (
+    CORPORA, SIZES, Benchmark, compare_results, get_compile_benchmarks, load_results, measure, save_results
+)
+from myapp.modules.compilation import compile_service
+
+
+class Command(BaseCommand):
+    help = "Times the markdown compiler and the paste views, optionally comparing against earlier results"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--only", choices=("compile", "views"), help="only run one kind of benchmarks")
+        parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="paste sizes in characters")
+        parser.add_argument("--filter", default="", help="only run benchmarks with this in their name")
+        parser.add_argument("--min-time", type=float, default=0.5, help="seconds to spend on every benchmark")
+        parser.add_argument("--output", help="json file to save the results to")
+        parser.add_argument("--compare", help="json file with earlier results to compare against")
+        parser.add_argument(
+            "--budget", type=float, default=1.25,
+            help="how many times slower than in --compare a benchmark may get before this fails"
+        )
+
+    def handle(self, *args, **options):
+        results = {}
+        if options["only"] != "views":
+            self.run(get_compile_benchmarks(options["sizes"]), options, results)
+        if options["only"] != "compile":
+            self.run_views(options, results)
+
+        if options["output"]:
+            save_results(options["output"], results)
+            self.stdout.write(f"results saved to {options['output']}")
+
+        if options["compare"]:
+            self.compare(load_results(options["compare"]), results, options["budget"])
+
+    def run(self, benchmarks: list[Benchmark], options: dict, results: dict):
+        for benchmark in benchmarks:
+            if options["filter"] not in benchmark.name:
+                continue
+
+            results[benchmark.name] = result = measure(benchmark.fn, benchmark.arg, min_time=options["min_time"])
+            self.stdout.write(
+                f"{benchmark.name:<48} median {result['median'] * 1000:10.3f}ms"
+                f"  min {result['min'] * 1000:10.3f}ms  ({result['rounds']} rounds)"
+            )
+
+    # whole requests through the test client, in a throwaway test database
+    def run_views(self, options: dict, results: dict):
+        runner = DiscoverRunner(verbosity=0)
+        setup_test_environment()
+        old_config = runner.setup_databases()
+        try:
+            self.run(self.get_view_benchmarks(options["sizes"]), options, results)
+        finally:
+            runner.teardown_databases(old_config)
+            teardown_test_environment()
+
+    @staticmethod
+    def get_view_benchmarks(sizes) -> list[Benchmark]:
+        client = Client()
+        urls = (f"bench-{i}" for i in count())
+
+        def clear_caches():
+            pages.page_cache.local.clear()
+            if compile_service.blocks is not None:
+                compile_service.blocks.clear()
+
+        def create(content: str):
+            clear_caches()
+            paste_url = next(urls)
+            # the same content would just point to the blob of the first paste
+            response = client.post(reverse("myapp:create"), {
+                'content': f"{paste_url}\r\n\r\n{content}",
+                'paste_url': paste_url,
+                'edit_code': "benchmark"
+            })
+            assert response.status_code == 302, response.content
+
+        def get(url: str, cached: bool = False):
+            if not cached:
+                clear_caches()
+            response = client.get(url)
+            assert response.status_code == 200
+
+        # a page with nothing but the middleware and a template
+        benchmarks = [Benchmark("index", get, reverse("myapp:index"))]
+        for size in sizes:
+            content = CORPORA['realistic'](size)
+            paste_url = f"bench-view-{size}"
+            create_response = client.post(reverse("myapp:create"), {
+                'content': content,
+                'paste_url': paste_url,
+                'edit_code': "benchmark"
+            })
+            if create_response.status_code != 302:
+                raise CommandError(f"could not create a paste of {size} characters to benchmark")
+
+            benchmarks += [
+                Benchmark(f"create/realistic/{size}", create, content),
+                Benchmark(f"view/realistic/{size}", get, reverse("myapp:view", args=(paste_url,))),
+                Benchmark(
+                    f"view_cached/realistic/{size}", lambda url: get(url, cached=True),
+                    reverse("myapp:view", args=(paste_url,))
+                ),
+                Benchmark(f"raw/realistic/{size}", get, reverse("myapp:raw", args=(paste_url,))),
+            ]
+        return benchmarks
+
+    def compare(self, baseline: dict, results: dict, budget: float):
+        ratios, regressions = compare_results(baseline, results, budget)
+        for name, ratio in ratios.items():
+            line = f"{name:<48} {ratio:6.2f}x"
+            self.stdout.write(self.style.ERROR(line) if name in regressions else line)
+
+        if regressions:
+            raise CommandError(f"{len(regressions)} benchmarks got more than {budget:.2f}x slower")
+        self.stdout.write(self.style.SUCCESS(f"no benchmark got more than {budget:.2f}x slower"))
@@ -0,0 +1,55 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from myapp.modules.benchmarks import SIZES, measure_cold_start
+
+
+class Command(BaseCommand):
+    help = "Compares how fast new processes start and serve pages with every settings profile"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--profiles", nargs="+", default=["development", "production"])
+        parser.add_argument("--rounds", type=int, default=10, help="new processes to start for every profile")
+        parser.add_argument("--sizes", type=int, nargs="+", default=SIZES[:2], help="paste sizes in characters")
+        parser.add_argument("--min-time", type=float, default=0.5, help="seconds to spend on every view benchmark")
+
+    def handle(self, *args, **options):
+        results = {}
+        for profile in options["profiles"]:
+            self.stdout.write(f"benchmarking the {profile} profile")
+            env = {'SETTINGS_PROFILE': profile}
+            results[profile] = {
+                "cold_start": measure_cold_start(env, settings.BASE_DIR, options["rounds"]),
+                **self.run_views(env, options),
+            }
+
+        baseline, *others = options["profiles"]
+        self.stdout.write(f"{'':<40}" + "".join(f"{profile:>16}" for profile in options["profiles"]))
+        for name, result in results[baseline].items():
+            line = f"{name:<40}{result['median'] * 1000:14.3f}ms"
+            for profile in others:
+                median = results[profile][name]['median']
+                line += f"{median * 1000:14.3f}ms ({median / result['median']:.2f}x)"
+            self.stdout.write(line)
+
+    # the view benchmarks have to run in another process, as settings can't change in this one
+    @staticmethod
+    def run_views(env: dict[str, str], options: dict) -> dict[str, dict]:
+        with tempfile.TemporaryDirectory() as directory:
+            output = Path(directory) / "results.json"
+            subprocess.run(
+                [
+                    sys.executable, "manage.py", "benchmark", "--only", "views", "--output", str(output),
+                    "--min-time", str(options["min_time"]), "--sizes", *map(str, options["sizes"]),
+                ],
+                env={**os.environ, **env}, cwd=settings.BASE_DIR, check=True, stdout=subprocess.DEVNULL
+            )
+            return json.loads(output.read_text())['results']
+
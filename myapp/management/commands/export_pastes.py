@@ -0,0 +1,51 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from myapp.models import Paste
+
+
+class Command(BaseCommand):
+    help = (
+        "Writes every paste as a line of json, to be read by import_pastes. edit codes are only exported "
+        "as their hashes, which only work where SECRET_KEY is the same"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("output", nargs="?", default="-", help="file to write to, - for stdout")
+        parser.add_argument("--batch-size", type=int, default=500, help="how many pastes to load at once")
+
+    def handle(self, *args, **options):
+        if options["output"] == "-":
+            exported = self.export(self.stdout, options["batch_size"])
+        else:
+            with open(options["output"], "w", encoding="utf-8") as output:
+                exported = self.export(output, options["batch_size"])
+
+        self.stderr.write(f"exported {exported} pastes")
+
+    @staticmethod
+    def export(output, batch_size: int) -> int:
+        pastes = Paste.objects.order_by("pk").values_list(
+            "pk", "url_name", "blob__content", "edit_code", "creation_date", "edited_date", "expires_at"
+        )
+
+        exported, last_pk = 0, 0
+        while True:
+            # every batch starts where the previous one ended, so only one batch is ever in memory
+            batch = list(pastes.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                return exported
+
+            for _, url_name, content, edit_code, creation_date, edited_date, expires_at in batch:
+                output.write(json.dumps({
+                    'url_name': url_name,
+                    'content': content,
+                    'edit_code_hash': edit_code,
+                    'creation_date': creation_date.isoformat(),
+                    'edited_date': edited_date.isoformat(),
+                    'expires_at': expires_at.isoformat() if expires_at is not None else None,
+                }) + "\n")
+
+            exported += len(batch)
+            last_pk = batch[-1][0]
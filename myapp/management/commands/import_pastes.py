@@ -0,0 +1,162 @@
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from django.core.management.base import BaseCommand
+from django.db import router, transaction
+from django.db.models import Count, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from myapp.models import Blob, Paste, hash_content
+from myapp.modules import search
+from myapp.modules.markdown import COMPILER_VERSION, compile_paste
+from myapp.modules.utils import hash_sha512
+from myapp.pages import prepare_create, validate_create
+
+
+_STRING_FIELDS = ('url_name', 'content', 'edit_code', 'edit_code_hash', 'creation_date', 'edited_date', 'expires_at')
+
+
+# a date of a record, none if it is missing
+def _parse_date(value: str | None):
+    if not value:
+        return None
+    date = parse_datetime(value)  # raises ValueError for dates which don't exist, like a 13th month
+    if date is None:
+        raise ValueError(f"not a date: {value!r}")
+    return date
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates pastes out of lines of json like export_pastes writes, with `url_name` (random if empty), "
+        "`content`, either `edit_code` or `edit_code_hash` and optionally `expires_at`. pastes which `create` "
+        "wouldn't let through, like ones with urls which are already taken, are reported and skipped"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", nargs="?", default="-", help="file to read from, - for stdin")
+        parser.add_argument("--batch-size", type=int, default=500, help="how many pastes to save in one transaction")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="how many processes compile pastes")
+
+    def handle(self, *args, **options):
+        input_file = sys.stdin if options["input"] == "-" else open(options["input"], encoding="utf-8")
+        imported = rejected = 0
+        try:
+            with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+                lines = enumerate(input_file, 1)
+                while batch := list(islice(lines, options["batch_size"])):
+                    pastes, contents, errors = self.read_batch(batch)
+                    saved, dropped = self.save_batch(executor, pastes, contents, options["workers"])
+                    errors += [
+                        (line_number, f"{paste_url}: such url was just taken")
+                        for line_number, paste_url in dropped
+                    ]
+                    for line_number, error in sorted(errors):
+                        self.stderr.write(f"line {line_number}: {error}")
+
+                    imported += saved
+                    rejected += len(errors)
+                    self.stdout.write(f"{imported} pastes imported, {rejected} rejected")
+        finally:
+            if input_file is not sys.stdin:
+                input_file.close()
+
+        self.stdout.write(self.style.SUCCESS(f"imported {imported} pastes, rejected {rejected}"))
+
+    # pastes of the lines which `create` would let through with their line numbers,
+    # their contents by hash and why the other lines were rejected
+    @staticmethod
+    def read_batch(
+        batch: list[tuple[int, str]]
+    ) -> tuple[list[tuple[int, Paste]], dict[str, str], list[tuple[int, str]]]:
+        records, errors = [], []
+        for line_number, line in batch:
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise TypeError("not an object")
+                for name in _STRING_FIELDS:
+                    if record.get(name) is not None and not isinstance(record[name], str):
+                        raise TypeError(f"{name} is not a string")
+                dates = {name: _parse_date(record.get(name)) for name in ('creation_date', 'edited_date', 'expires_at')}
+                post = {
+                    'content': record['content'],
+                    'paste_url': record.get('url_name') or "",
+                    'edit_code': record.get('edit_code') or record['edit_code_hash'],
+                }
+            except (ValueError, KeyError, TypeError) as e:
+                errors.append((line_number, f"not a paste ({e!r})"))
+                continue
+            records.append((line_number, record, dates, post, *prepare_create(post)))
+
+        taken = set(Paste.objects.filter(url_name__in=[
+            paste_url for *_, paste_url in records
+        ]).values_list("url_name", flat=True))
+
+        now = timezone.now()
+        pastes, contents = [], {}
+        for line_number, record, dates, post, content, paste_url in records:
+            error_messages = validate_create(post, content, paste_url, paste_url in taken)
+            if error_messages:
+                errors.append((line_number, f"{paste_url}: {', '.join(error_messages)}"))
+                continue
+            taken.add(paste_url)  # the same url twice in one file
+
+            creation_date = dates['creation_date'] or now
+            content_hash = hash_content(content)
+            contents[content_hash] = content
+            pastes.append((line_number, Paste(
+                blob_id=content_hash,
+                url_name=paste_url,
+                edit_code=record.get('edit_code_hash') or hash_sha512(record['edit_code']),
+                creation_date=creation_date,
+                edited_date=dates['edited_date'] or creation_date,
+                expires_at=dates['expires_at'],
+            )))
+
+        return pastes, contents, errors
+
+    # how many pastes were saved, and the line numbers and urls of the ones which
+    # weren't because someone else took their url since they were checked
+    @staticmethod
+    def save_batch(
+        executor: ProcessPoolExecutor, pastes: list[tuple[int, Paste]], contents: dict[str, str], workers: int
+    ) -> tuple[int, list[tuple[int, str]]]:
+        if not pastes:
+            return 0, []
+
+        # only contents which nobody pasted yet are compiled and stored
+        existing = set(Blob.objects.filter(pk__in=contents).values_list("pk", flat=True))
+        new = {content_hash: content for content_hash, content in contents.items() if content_hash not in existing}
+        compiled = list(executor.map(compile_paste, new.values(), chunksize=max(len(new) // (workers * 4), 1)))
+
+        with transaction.atomic():
+            Blob.objects.bulk_create([
+                Blob(hash=content_hash, content=content, compiled=html, compiler_version=COMPILER_VERSION)
+                for (content_hash, content), html in zip(new.items(), compiled)
+            ], ignore_conflicts=True)
+            # urls taken since they were checked are skipped too
+            Paste.objects.bulk_create([paste for _, paste in pastes], ignore_conflicts=True)
+
+            blobs = Blob.objects.filter(pk__in=contents)
+            blobs.update(references=Coalesce(Subquery(
+                Paste.objects.filter(blob=OuterRef('pk')).order_by()
+                .values('blob').annotate(references=Count('pk')).values('references')
+            ), Value(0)))
+            blobs.filter(references=0).delete()
+
+            imported = list(Paste.objects.filter(
+                url_name__in=[paste.url_name for _, paste in pastes], blob__in=contents,
+                edit_code__in=[paste.edit_code for _, paste in pastes]
+            ).values_list("pk", "blob", "url_name"))
+            search.index_pastes(router.db_for_write(Paste), [(pk, contents[blob]) for pk, blob, _ in imported])
+
+        imported_urls = {paste_url for _, _, paste_url in imported}
+        return len(imported), [
+            (line_number, paste.url_name) for line_number, paste in pastes if paste.url_name not in imported_urls
+        ]
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, router, transaction
+
+from myapp.models import Paste
+from myapp.modules import search
+
+
+class Command(BaseCommand):
+    help = "Adds pastes which are not in the search index yet, in batches ordered by id"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="how many pastes to load and index at once")
+        parser.add_argument("--start-after", type=int, default=0, help="id of the last paste done, to resume from")
+        parser.add_argument("--rebuild", action="store_true", help="empty the index first")
+
+    def handle(self, *args, **options):
+        alias = router.db_for_write(Paste)
+        if not search.is_enabled(alias):
+            raise CommandError("search needs PASTE_SEARCH on and an sqlite database")
+
+        if options["rebuild"]:
+            with transaction.atomic(using=alias):
+                search.clear(alias)
+
+        pastes = Paste.objects.order_by("pk").values_list("pk", "blob__content")
+        total = pastes.filter(pk__gt=options["start_after"]).count()
+        done, last_pk = 0, options["start_after"]
+
+        while True:
+            # every batch starts where the previous one ended
+            batch = list(pastes.filter(pk__gt=last_pk)[:options["batch_size"]])
+            if not batch:
+                break
+
+            # a short transaction per batch, so pastes can still be created meanwhile
+            with transaction.atomic(using=alias):
+                search.index_pastes(alias, batch)
+
+            done += len(batch)
+            last_pk = batch[-1][0]
+            self.stdout.write(f"{done}/{total} pastes indexed, last id {last_pk}")
+
+        # merges the index segments the batches left behind
+        with connections[alias].cursor() as cursor:
+            cursor.execute(f"INSERT INTO {search.TABLE} ({search.TABLE}) VALUES ('optimize')")
+
+        self.stdout.write(self.style.SUCCESS(f"indexed {done} pastes"))
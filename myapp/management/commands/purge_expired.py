@@ -0,0 +1,70 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections, router, transaction
+
+from myapp.models import Paste
+
+
+class Command(BaseCommand):
+    help = "Deletes expired pastes in small batches ordered by id, optionally giving the space back to the disk"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=200, help="how many pastes to delete in one transaction")
+        parser.add_argument("--pause", type=float, default=0.0, help="seconds to wait between batches")
+        parser.add_argument(
+            "--vacuum", action="store_true",
+            help="afterwards free the pages of deleted rows with sqlite incremental vacuum"
+        )
+        parser.add_argument(
+            "--vacuum-pages", type=int, default=1000, help="how many pages one incremental vacuum step frees"
+        )
+
+    def handle(self, *args, **options):
+        deleted, last_pk = 0, 0
+        while True:
+            # ids first, so every transaction only holds the write lock for the rows it deletes
+            ids = list(
+                Paste.objects.expired().filter(pk__gt=last_pk).order_by("pk")
+                .values_list("pk", flat=True)[:options["batch_size"]]
+            )
+            if not ids:
+                break
+
+            # every deleted paste releases its blob and leaves the search index (see `models`)
+            with transaction.atomic():
+                Paste.objects.expired().filter(pk__in=ids).delete()
+
+            deleted += len(ids)
+            last_pk = ids[-1]
+            self.stdout.write(f"{deleted} expired pastes deleted, last id {last_pk}")
+            if options["pause"]:
+                time.sleep(options["pause"])
+
+        self.stdout.write(self.style.SUCCESS(f"deleted {deleted} expired pastes"))
+
+        if options["vacuum"]:
+            self.vacuum(connections[router.db_for_write(Paste)], options["vacuum_pages"])
+
+    def vacuum(self, connection, pages: int):
+        if connection.vendor != 'sqlite':
+            self.stdout.write("only sqlite needs vacuuming by hand, postgres does it by itself")
+            return
+
+        with connection.cursor() as cursor:
+            if cursor.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # switching it on rewrites the whole file once, which locks it for a while
+                self.stderr.write(
+                    "incremental vacuum is off for this database, turn it on once with "
+                    "`PRAGMA auto_vacuum = INCREMENTAL; VACUUM;` while nothing else is running"
+                )
+                return
+
+            free = cursor.execute("PRAGMA freelist_count").fetchone()[0]
+
+        # small steps, so writers only ever wait for one of them. through the sqlite3 connection itself,
+        # as a cursor only runs the pragma for its first row, which frees a single page
+        for _ in range(0, free, pages):
+            connection.connection.executescript(f"PRAGMA incremental_vacuum({pages})")
+
+        self.stdout.write(self.style.SUCCESS(f"gave {free} free pages back to the disk"))
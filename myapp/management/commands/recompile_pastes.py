@@ -0,0 +1,58 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from myapp.models import Blob
+from myapp.modules.markdown import COMPILER_VERSION, compile_paste
+
+
+class Command(BaseCommand):
+    help = "Recompiles pastes in parallel, in batches ordered by content hash"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500, help="how many pastes to load and save at once")
+        parser.add_argument("--workers", type=int, default=os.cpu_count(), help="how many processes compile pastes")
+        parser.add_argument("--start-after", default="", help="content hash of the last paste done, to resume from")
+        parser.add_argument(
+            "--only-stale", action="store_true",
+            help="only recompile pastes made by an older compiler or shown as plain text"
+        )
+
+    def handle(self, *args, **options):
+        # pastes with the same content share a blob, which is only compiled once
+        blobs = Blob.objects.order_by("pk")
+        if options["only_stale"]:
+            blobs = blobs.exclude(compiler_version=COMPILER_VERSION)
+
+        total = blobs.filter(pk__gt=options["start_after"]).count()
+        done, last_pk = 0, options["start_after"]
+
+        with ProcessPoolExecutor(max_workers=options["workers"]) as executor:
+            while True:
+                # every batch starts where the previous one ended
+                batch = list(blobs.filter(pk__gt=last_pk).values_list("pk", "content")[:options["batch_size"]])
+                if not batch:
+                    break
+
+                compiled = executor.map(
+                    compile_paste, [content for _, content in batch],
+                    chunksize=max(len(batch) // (options["workers"] * 4), 1)
+                )
+                updated = self.save_batch(dict(zip([pk for pk, _ in batch], compiled)))
+
+                done += len(batch)
+                last_pk = batch[-1][0]
+                self.stdout.write(
+                    f"{done}/{total} pastes recompiled ({len(batch) - updated} deleted meanwhile), last hash {last_pk}"
+                )
+
+        self.stdout.write(self.style.SUCCESS(f"recompiled {done} pastes"))
+
+    @staticmethod
+    def save_batch(compiled: dict) -> int:
+        # blobs never change, but the last paste pointing to one might have been edited meanwhile
+        return Blob.objects.bulk_update(
+            [Blob(pk=pk, compiled=html, compiler_version=COMPILER_VERSION) for pk, html in compiled.items()],
+            ["compiled", "compiler_version"]
+        )
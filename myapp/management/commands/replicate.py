@@ -0,0 +1,38 @@
+import sqlite3
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Copies the sqlite database into every sqlite replica in DB_REPLICAS, again and again"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--interval", type=float, default=settings.DB_REPLICA_LAG,
+            help="seconds between copies, which is how far behind the replicas get"
+        )
+        parser.add_argument("--once", action="store_true", help="copy once and stop")
+
+    def handle(self, *args, **options):
+        replicas = [alias for alias in settings.DATABASES if alias.startswith("replica_")]
+        if not replicas:
+            raise CommandError("there are no replicas, set DB_REPLICAS")
+        if any(settings.DATABASES[alias]['ENGINE'] != 'django.db.backends.sqlite3' for alias in replicas):
+            raise CommandError("only sqlite databases can be replicated like this")
+
+        while True:
+            started = time.perf_counter()
+            # a backup sees the primary at one point in time, like a real replica would
+            with sqlite3.connect(settings.DATABASES['default']['NAME']) as primary:
+                for alias in replicas:
+                    with sqlite3.connect(settings.DATABASES[alias]['NAME']) as replica:
+                        primary.backup(replica)
+                    replica.close()
+            primary.close()
+            self.stdout.write(f"copied to {len(replicas)} replicas in {time.perf_counter() - started:.3f}s")
+
+            if options["once"]:
+                break
+            time.sleep(options["interval"])
@@ -0,0 +1,90 @@
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.utils.decorators import sync_and_async_middleware
+
+from .modules.db import start_routing, stop_routing
+from .modules.timing import get_server_timing, request_metrics, start_timing, stop_timing
+
+
+def _finish(request, response, timings: dict[str, float], started: float):
+    total = time.perf_counter() - started
+    # streamed pages are only timed up to their first byte
+    response.headers['Server-Timing'] = get_server_timing(timings, total)
+
+    match = request.resolver_match
+    request_metrics.observe(match.view_name if match is not None else "<unresolved>", total, timings)
+    return response
+
+
+# times db queries, compiling, hashing and rendering of every request, puts the times
+# into a `Server-Timing` header and keeps histograms of them for `status/metrics`
+@sync_and_async_middleware
+def request_timing_middleware(get_response):
+    if not settings.REQUEST_TIMING:
+        raise MiddlewareNotUsed
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            started = time.perf_counter()
+            timings, token = start_timing()
+            try:
+                response = await get_response(request)
+            finally:
+                stop_timing(token)
+            return _finish(request, response, timings, started)
+    else:
+        def middleware(request):
+            started = time.perf_counter()
+            timings, token = start_timing()
+            try:
+                response = get_response(request)
+            finally:
+                stop_timing(token)
+            return _finish(request, response, timings, started)
+
+    return middleware
+
+
+# name of the cookie which sends reads of the client to the primary after it wrote something
+PRIMARY_COOKIE = "opyn_primary"
+
+
+def _start_routing(request):
+    # `create` and `edit` check if urls are taken on the primary too
+    return start_routing(request.method not in ("GET", "HEAD") or PRIMARY_COOKIE in request.COOKIES)
+
+
+def _finish_routing(response, state: dict[str, bool]):
+    if state['wrote']:
+        # the redirect after `create` and `edit` has to find the paste
+        response.set_cookie(PRIMARY_COOKIE, "1", max_age=settings.DB_REPLICA_LAG, httponly=True, samesite="Lax")
+    return response
+
+
+# sends reads to the replicas in `DB_REPLICAS` (see `myapp.modules.db.ReplicaRouter`)
+@sync_and_async_middleware
+def replica_middleware(get_response):
+    if not settings.DB_REPLICAS:
+        raise MiddlewareNotUsed
+
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            state, token = _start_routing(request)
+            try:
+                response = await get_response(request)
+            finally:
+                stop_routing(token)
+            return _finish_routing(response, state)
+    else:
+        def middleware(request):
+            state, token = _start_routing(request)
+            try:
+                response = get_response(request)
+            finally:
+                stop_routing(token)
+            return _finish_routing(response, state)
+
+    return middleware
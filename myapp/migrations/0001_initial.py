@@ -0,0 +1,26 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Paste',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField()),
+                ('url_name', models.SlugField(max_length=256, unique=True)),
+                ('edit_code', models.CharField(max_length=512)),
+                ('compiled', models.TextField()),
+                ('creation_date', models.DateTimeField()),
+                ('edited_date', models.DateTimeField()),
+            ],
+        ),
+    ]
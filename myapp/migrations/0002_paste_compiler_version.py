@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paste',
+            name='compiler_version',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
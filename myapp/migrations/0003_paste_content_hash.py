@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:33
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def hash_contents(apps, schema_editor):
+    Paste = apps.get_model('myapp', 'Paste')
+
+    last_pk = 0
+    while True:
+        batch = list(Paste.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'content')[:500])
+        if not batch:
+            break
+
+        Paste.objects.bulk_update([
+            Paste(pk=pk, content_hash=hashlib.sha256(content.encode('utf-8')).hexdigest()) for pk, content in batch
+        ], ['content_hash'])
+        last_pk = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0002_paste_compiler_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paste',
+            name='content_hash',
+            field=models.CharField(default='', max_length=64),
+        ),
+        migrations.RunPython(hash_contents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,102 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:02
+
+from django.db import migrations, models
+
+import myapp.fields
+
+
+def compress_texts(apps, schema_editor):
+    Paste = apps.get_model('myapp', 'Paste')
+
+    last_pk = 0
+    while True:
+        batch = list(
+            Paste.objects.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'content', 'compiled')[:500]
+        )
+        if not batch:
+            break
+
+        Paste.objects.bulk_update([
+            Paste(pk=pk, compressed_content=content, compressed_compiled=compiled) for pk, content, compiled in batch
+        ], ['compressed_content', 'compressed_compiled'])
+        last_pk = batch[-1][0]
+
+
+def decompress_texts(apps, schema_editor):
+    Paste = apps.get_model('myapp', 'Paste')
+
+    last_pk = 0
+    while True:
+        batch = list(
+            Paste.objects.filter(pk__gt=last_pk).order_by('pk')
+            .values_list('pk', 'compressed_content', 'compressed_compiled')[:500]
+        )
+        if not batch:
+            break
+
+        Paste.objects.bulk_update([
+            Paste(pk=pk, content=content, compiled=compiled) for pk, content, compiled in batch
+        ], ['content', 'compiled'])
+        last_pk = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0003_paste_content_hash'),
+    ]
+
+    # the compressed columns are added next to the old ones and swapped in
+    # once everything is copied over, text can't be cast to binary everywhere
+    operations = [
+        migrations.AddField(
+            model_name='paste',
+            name='compressed_content',
+            field=myapp.fields.CompressedTextField(null=True),
+        ),
+        migrations.AddField(
+            model_name='paste',
+            name='compressed_compiled',
+            field=myapp.fields.CompressedTextField(codec='deflate', min_length=0, null=True),
+        ),
+        migrations.RunPython(compress_texts, decompress_texts),
+        # so they can be added back with something in them when going back
+        migrations.AlterField(
+            model_name='paste',
+            name='content',
+            field=models.TextField(default=''),
+        ),
+        migrations.AlterField(
+            model_name='paste',
+            name='compiled',
+            field=models.TextField(default=''),
+        ),
+        migrations.RemoveField(
+            model_name='paste',
+            name='content',
+        ),
+        migrations.RemoveField(
+            model_name='paste',
+            name='compiled',
+        ),
+        migrations.RenameField(
+            model_name='paste',
+            old_name='compressed_content',
+            new_name='content',
+        ),
+        migrations.RenameField(
+            model_name='paste',
+            old_name='compressed_compiled',
+            new_name='compiled',
+        ),
+        migrations.AlterField(
+            model_name='paste',
+            name='content',
+            field=myapp.fields.CompressedTextField(),
+        ),
+        migrations.AlterField(
+            model_name='paste',
+            name='compiled',
+            field=myapp.fields.CompressedTextField(codec='deflate', min_length=0),
+        ),
+    ]
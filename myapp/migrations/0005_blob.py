@@ -0,0 +1,120 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:31
+
+import hashlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+
+import myapp.fields
+
+
+def move_to_blobs(apps, schema_editor):
+    Blob = apps.get_model('myapp', 'Blob')
+    Paste = apps.get_model('myapp', 'Paste')
+
+    last_pk = 0
+    while True:
+        batch = list(
+            Paste.objects.filter(pk__gt=last_pk).order_by('pk')
+            .values_list('pk', 'content', 'content_hash', 'compiled', 'compiler_version')[:500]
+        )
+        if not batch:
+            break
+
+        blobs = {}
+        for pk, content, content_hash, compiled, compiler_version in batch:
+            content_hash = content_hash or hashlib.sha256(content.encode('utf-8')).hexdigest()
+            blobs[content_hash] = Blob(
+                hash=content_hash, content=content, compiled=compiled, compiler_version=compiler_version
+            )
+        # pastes with the same content in different batches only keep the first blob
+        Blob.objects.bulk_create(blobs.values(), ignore_conflicts=True)
+        Paste.objects.bulk_update([
+            Paste(pk=pk, content_hash=content_hash or hashlib.sha256(content.encode('utf-8')).hexdigest())
+            for pk, content, content_hash, _, _ in batch
+        ], ['content_hash'])
+        last_pk = batch[-1][0]
+
+    Blob.objects.update(references=Subquery(
+        Paste.objects.filter(content_hash=OuterRef('pk')).order_by()
+        .values('content_hash').annotate(references=Count('pk')).values('references')
+    ))
+
+
+def move_from_blobs(apps, schema_editor):
+    Paste = apps.get_model('myapp', 'Paste')
+
+    last_pk = 0
+    while True:
+        batch = list(
+            Paste.objects.filter(pk__gt=last_pk).order_by('pk')
+            .values_list('pk', 'blob__content', 'blob__compiled', 'blob__compiler_version')[:500]
+        )
+        if not batch:
+            break
+
+        Paste.objects.bulk_update([
+            Paste(pk=pk, content=content, compiled=compiled, compiler_version=compiler_version)
+            for pk, content, compiled, compiler_version in batch
+        ], ['content', 'compiled', 'compiler_version'])
+        last_pk = batch[-1][0]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0004_compress_paste_text'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('content', myapp.fields.CompressedTextField()),
+                ('compiled', myapp.fields.CompressedTextField(codec='deflate', min_length=0)),
+                ('compiler_version', models.PositiveIntegerField(default=0)),
+                ('references', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        # going back, blobs are only read after the paste points to them again
+        migrations.RunPython(move_to_blobs, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='paste',
+            name='content_hash',
+            field=models.ForeignKey(
+                db_column='content_hash', on_delete=django.db.models.deletion.PROTECT, related_name='pastes',
+                to='myapp.blob'
+            ),
+        ),
+        migrations.RenameField(
+            model_name='paste',
+            old_name='content_hash',
+            new_name='blob',
+        ),
+        migrations.RunPython(migrations.RunPython.noop, move_from_blobs),
+        # so they can be added back with something in them when going back
+        migrations.AlterField(
+            model_name='paste',
+            name='content',
+            field=myapp.fields.CompressedTextField(default=''),
+        ),
+        migrations.AlterField(
+            model_name='paste',
+            name='compiled',
+            field=myapp.fields.CompressedTextField(codec='deflate', default='', min_length=0),
+        ),
+        migrations.RemoveField(
+            model_name='paste',
+            name='content',
+        ),
+        migrations.RemoveField(
+            model_name='paste',
+            name='compiled',
+        ),
+        migrations.RemoveField(
+            model_name='paste',
+            name='compiler_version',
+        ),
+    ]
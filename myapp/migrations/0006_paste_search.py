@@ -0,0 +1,30 @@
+from django.db import migrations
+
+
+# only sqlite has fts5, `PASTE_SEARCH` is ignored everywhere else. it is contentless
+# (`content = ''`), the pastes already keep their text
+def create_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE myapp_paste_search "
+        "USING fts5(content, content = '', tokenize = 'unicode61 remove_diacritics 2')"
+    )
+
+
+def drop_search_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute("DROP TABLE myapp_paste_search")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0005_blob'),
+    ]
+
+    # the table starts out empty, `manage.py index_pastes` fills it
+    operations = [
+        migrations.RunPython(create_search_table, drop_search_table),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('myapp', '0006_paste_search'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paste',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,12 +1,157 @@
-from django.db import models
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, models, transaction
+from django.db.models import F, Q
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .fields import CompressedTextField
+from .modules.compilation import CURRENT_VERSIONS, compile_service
+from .modules import search
+from .modules.singleflight import AsyncSingleFlight, SingleFlight
+
+
+def hash_content(content: str) -> str:
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+# recompiling the same blob at the same time is pointless
+_recompiles = SingleFlight()
+_arecompiles = AsyncSingleFlight()
+
+
+# markdown and its html, shared by every paste with the exact same markdown.
+# it is never changed, a paste which is edited points to another blob instead
+class Blob(models.Model):
+    hash = models.CharField(max_length=64, primary_key=True)  # sha256 of the markdown, also used for etags
+    content = CompressedTextField()  # markdown itself
+
+    # html of the markdown, stored so it can go out in gzip responses as is
+    compiled = CompressedTextField(codec='deflate', min_length=0)
+    # `COMPILER_VERSION` `compiled` was made with, or `PLAIN_VERSION` if it is only plain text
+    compiler_version = models.PositiveIntegerField(default=0)
+
+    references = models.PositiveIntegerField(default=0)  # how many pastes point to it
+
+    # one more paste points to the blob of `content`. `compiled` (the html and its compiler
+    # version, see `CompileService.compile`) is only needed if it doesn't exist yet
+    @classmethod
+    def acquire(cls, content_hash: str, content: str, compiled: tuple[str, int] | None):
+        if cls.objects.filter(pk=content_hash).update(references=F('references') + 1):
+            return
+
+        if compiled is None:  # it was released since it was looked up
+            compiled = compile_service.compile(content)
+
+        html, compiler_version = compiled
+        try:
+            with transaction.atomic():
+                cls.objects.create(
+                    hash=content_hash, content=content, compiled=html, compiler_version=compiler_version,
+                    references=1
+                )
+        except IntegrityError:  # someone else just created it
+            cls.objects.filter(pk=content_hash).update(references=F('references') + 1)
+
+    # one paste less points to the blob, it is deleted once nothing does
+    @classmethod
+    def release(cls, content_hash: str):
+        cls.objects.filter(pk=content_hash).update(references=F('references') - 1)
+        cls.objects.filter(pk=content_hash, references=0).delete()
+
+    # recompiles blobs compiled by an older compiler and saves the result. ones shown as plain text
+    # as they took too long to compile are left to `recompile_pastes`
+    def refresh_compiled(self):
+        if self.compiler_version in CURRENT_VERSIONS:
+            return
+
+        def recompile() -> tuple[str, int]:
+            compiled = compile_service.compile(self.content)  # loads `content` if it is deferred
+            Blob.objects.filter(pk=self.pk, compiler_version=self.compiler_version) \
+                .update(compiled=compiled[0], compiler_version=compiled[1])
+            return compiled
+
+        self.compiled, self.compiler_version = _recompiles.do(self.pk, recompile)
+
+    async def arefresh_compiled(self):
+        if self.compiler_version in CURRENT_VERSIONS:
+            return
+
+        # `content` is usually not loaded by now
+        content = self.content if 'content' in self.__dict__ else \
+            await Blob.objects.filter(pk=self.pk).values_list('content', flat=True).aget()
+
+        async def recompile() -> tuple[str, int]:
+            compiled = await compile_service.acompile(content)
+            await Blob.objects.filter(pk=self.pk, compiler_version=self.compiler_version) \
+                .aupdate(compiled=compiled[0], compiler_version=compiled[1])
+            return compiled
+
+        self.compiled, self.compiler_version = await _arecompiles.do(self.pk, recompile)
+
+
+class PasteQuerySet(models.QuerySet):
+    def unexpired(self):
+        return self.filter(Q(expires_at=None) | Q(expires_at__gt=timezone.now()))
+
+    def expired(self):
+        return self.filter(expires_at__lte=timezone.now())
 
 
 class Paste(models.Model):
-    content = models.TextField()  # markdown itself
+    # the markdown and its html, the column keeps its old name as it holds the same hash
+    blob = models.ForeignKey(Blob, models.PROTECT, related_name='pastes', db_column='content_hash')
     url_name = models.SlugField(max_length=256, unique=True)
     edit_code = models.CharField(max_length=512)
 
-    compiled = models.TextField()  # html of the markdown
-
     creation_date = models.DateTimeField()
     edited_date = models.DateTimeField()
+    # pages of the paste 404 from then on, until `manage.py purge_expired` deletes it
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
+
+    objects = PasteQuerySet.as_manager()
+
+    # saves the paste with `content`. pastes with the same content share a blob,
+    # so only the first one of them is compiled and stored
+    def save_content(self, content: str):
+        content_hash = hash_content(content)
+        compiled = None if Blob.objects.filter(pk=content_hash).exists() else compile_service.compile(content)
+        self._save_blob(content_hash, content, compiled)
+
+    async def asave_content(self, content: str):
+        content_hash = hash_content(content)
+        compiled = None if await Blob.objects.filter(pk=content_hash).aexists() else \
+            await compile_service.acompile(content)
+        # django can't do transactions in async code yet
+        await sync_to_async(self._save_blob)(content_hash, content, compiled)
+
+    def _save_blob(self, content_hash: str, content: str, compiled: tuple[str, int] | None):
+        old_hash = self.blob_id
+        with transaction.atomic():
+            if content_hash != old_hash:
+                Blob.acquire(content_hash, content, compiled)
+                self.blob_id = content_hash
+
+            self.save()
+
+            if old_hash is not None and content_hash != old_hash:
+                _unindex(self, old_hash)
+                Blob.release(old_hash)
+            if content_hash != old_hash:
+                search.index_pastes(self._state.db, [(self.pk, content)])
+
+
+# takes the paste out of the search index, which needs the content it was indexed with
+def _unindex(paste: Paste, content_hash: str):
+    if search.is_enabled(paste._state.db):
+        content = Blob.objects.only('content').get(pk=content_hash).content
+        search.unindex_pastes(paste._state.db, [(paste.pk, content)])
+
+
+# covers deleting pastes one by one and in bulk
+@receiver(post_delete, sender=Paste)
+def _release_blob(sender, instance: Paste, **kwargs):
+    _unindex(instance, instance.blob_id)
+    Blob.release(instance.blob_id)
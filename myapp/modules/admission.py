@@ -0,0 +1,66 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+# a bucket of `burst` tokens per client, filling up with `rate` tokens a second. every
+# request takes a token, clients with an empty bucket have to wait for the next one.
+# every process has its own buckets, the least recently seen clients are forgotten first
+class TokenBuckets:
+    def __init__(self, rate: float, burst: int, max_clients: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()  # tokens and when they were counted
+        self._lock = threading.Lock()
+
+    # 0 if `client` got a token, otherwise seconds until it gets one
+    def take(self, client: str) -> float:
+        now = time.monotonic()
+        with self._lock:
+            tokens, counted = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - counted) * self.rate)
+
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+# at most `limit` requests at once, the rest wait for up to `timeout` seconds for a slot (or not at all)
+class ConcurrencyLimit:
+    def __init__(self, limit: int, timeout: float):
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(limit)
+
+    def acquire(self) -> bool:
+        return self._slots.acquire(timeout=self.timeout)
+
+    # without waiting for a slot
+    def try_acquire(self) -> bool:
+        return self._slots.acquire(blocking=False)
+
+    # polls instead of blocking the event loop, a request which is cancelled while waiting can't take a slot
+    async def aacquire(self) -> bool:
+        deadline = time.monotonic() + self.timeout
+        while not self._slots.acquire(blocking=False):
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.01)
+        return True
+
+    def release(self):
+        self._slots.release()
+
+
+def retry_after(seconds: float) -> str:
+    return str(max(1, math.ceil(seconds)))
@@ -0,0 +1,137 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Callable, NamedTuple
+
+import django
+from django.utils.html import escape
+
+from .markdown import COMPILER_VERSION, compile_md, create_compiler
+
+# biggest paste `create` and `edit` let through
+MAX_PASTE_SIZE = 262144
+SIZES = (1024, 16384, 65536, MAX_PASTE_SIZE)
+
+_REALISTIC_PASTE = (
+    "# some notes\r\n\r\n"
+    "## why\r\n\r\ntext can be **bold** btw, or *italic*, or ***both***\r\nand __underlined__ or ~~striked~~\r\n\r\n"
+    "-> centered <-\r\n\r\n-> right aligned ->\r\n\r\n"
+    "### todo\r\n\r\n* one\r\n* two\r\n* **three**\r\n---\r\n"
+    "Traceback (most recent call last):\r\n  File \"manage.py\", line 22, in <module>\r\n"
+    "    main()\r\nKeyError: '__init__'\r\n\r\n<script>alert(1)</script> & **kwargs *args\r\n\r\n"
+)
+
+
+def _repeat(s: str, size: int) -> str:
+    return (s * (size // len(s) + 1))[:size]
+
+
+# what pastes look like and what makes the compiler work the hardest,
+# as a paste would come in (`compile_paste` escapes it first)
+CORPORA: dict[str, Callable[[int], str]] = {
+    'realistic': lambda size: _repeat(_REALISTIC_PASTE, size),
+    'unmatched_stars': lambda size: _repeat("*a ", size),
+    'deep_nesting': lambda size: _repeat("# **__~~*", size),
+    'break_lines': lambda size: _repeat("\r\n", size),
+    'arrows': lambda size: _repeat("-> a ", size),
+}
+
+
+class Benchmark(NamedTuple):
+    name: str
+    fn: Callable
+    arg: object
+
+
+def get_compile_benchmarks(sizes=SIZES) -> list[Benchmark]:
+    compiler = create_compiler()
+
+    benchmarks = []
+    for corpus, generate in CORPORA.items():
+        for size in sizes:
+            raw_md = escape(generate(size))
+            benchmarks.append(Benchmark(f"compile_md/{corpus}/{size}", compile_md, raw_md))
+            if corpus == 'realistic':
+                benchmarks.append(Benchmark(f"MarkdownCompiler.compile/{corpus}/{size}", compiler.compile, raw_md))
+    return benchmarks
+
+
+# runs `fn(arg)` at least `min_rounds` times and for at least `min_time` seconds
+def measure(fn: Callable, arg, min_rounds: int = 5, min_time: float = 0.5, max_rounds: int = 1000) -> dict:
+    fn(arg)  # warm up
+
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < max_rounds and (len(timings) < min_rounds or time.perf_counter() - started < min_time):
+        start = time.perf_counter()
+        fn(arg)
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'rounds': len(timings),
+    }
+
+
+# a new process up to its first response: importing settings, setting django up and
+# going through every middleware once
+_COLD_START = """
+import django.test
+from django.core.wsgi import get_wsgi_application
+get_wsgi_application()
+assert django.test.Client().get("/").status_code == 200
+"""
+
+
+# seconds it takes a new process with `env` added to its environment to serve a page, in `cwd`
+def measure_cold_start(env: dict[str, str], cwd: str, rounds: int = 10) -> dict:
+    env = {**os.environ, 'DJANGO_SETTINGS_MODULE': "opyn.settings", **env}
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", _COLD_START], env=env, cwd=cwd, check=True)
+        timings.append(time.perf_counter() - start)
+
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+        'rounds': len(timings),
+    }
+
+
+def get_machine() -> dict:
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'platform': platform.platform(),
+        'compiler_version': COMPILER_VERSION,
+    }
+
+
+def save_results(path: str, results: dict[str, dict]):
+    with open(path, "w") as f:
+        json.dump({'machine': get_machine(), 'results': results}, f, indent=2, sort_keys=True)
+
+
+def load_results(path: str) -> dict[str, dict]:
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+# how much slower every benchmark in both results got (by median), and the
+# ones which got slower than `budget` allows, ie 1.25 lets them be 25% slower
+def compare_results(
+    baseline: dict[str, dict], results: dict[str, dict], budget: float
+) -> tuple[dict[str, float], list[str]]:
+    ratios = {
+        name: results[name]['median'] / baseline[name]['median']
+        for name in results if name in baseline and baseline[name]['median'] > 0
+    }
+    return ratios, [name for name, ratio in ratios.items() if ratio > budget]
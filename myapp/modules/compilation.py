@@ -0,0 +1,235 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.html import escape
+
+from .markdown import COMPILER_VERSION, compile_blocks, compile_paste, split_paste
+from .timing import timed
+
+logger = logging.getLogger(__name__)
+
+
+# what a paste turns into when it takes too long to compile
+def compile_plain(content: str) -> str:
+    return f"<pre style=\"white-space: pre-wrap;\">{escape(content)}</pre>"
+
+
+# compiler version `compile_plain` html is stored with, the current one marked as having timed out.
+# pages take it as up to date so they don't wait for the same timeout on every view,
+# `recompile_pastes --only-stale` tries them again
+PLAIN_VERSION = COMPILER_VERSION + (1 << 16)
+# versions which pages don't compile again
+CURRENT_VERSIONS = (COMPILER_VERSION, PLAIN_VERSION)
+
+
+# about how many characters of blocks are cached together,
+# caching every break line by itself would cost more than compiling it
+_GROUP_SIZE = 512
+# groups never get bigger than this, except for a single block which is. those are
+# never cached, as a single one of them could push a good part of the cache out
+_MAX_GROUP_SIZE = 8 * _GROUP_SIZE
+
+
+# groups end on blocks picked by their content and not by where they are,
+# so an edit only changes the group it is in and not every group after it
+def _group_blocks(blocks: list[str]) -> list[str]:
+    groups, group, size = [], [], 0
+    for block in blocks:
+        if group and size + len(block) > _MAX_GROUP_SIZE:
+            groups.append("".join(group))
+            group, size = [], 0
+
+        group.append(block)
+        size += len(block)
+        if size >= _GROUP_SIZE and zlib.crc32(block.encode('utf-8')) % 4 == 0:
+            groups.append("".join(group))
+            group, size = [], 0
+
+    if group:
+        groups.append("".join(group))
+    return groups
+
+
+def _get_block_key(block: str, last: bool) -> str:
+    digest = hashlib.sha256(block.encode('utf-8')).hexdigest()
+    return f"opyn:block:{COMPILER_VERSION}:{int(last)}:{digest}"
+
+
+# the compiled groups which are small enough to be cached
+def _get_cacheable(compiled: dict[str, str], groups: dict[str, tuple[str, bool]]) -> dict[str, str]:
+    return {key: html for key, html in compiled.items() if len(groups[key][0]) <= _MAX_GROUP_SIZE}
+
+
+# the paste split into groups of blocks, with the cache key of every group
+def _split_groups(content: str) -> list[tuple[str, str, bool]]:
+    groups = _group_blocks(split_paste(content))
+    return [
+        (_get_block_key(group, k == len(groups) - 1), group, k == len(groups) - 1)
+        for k, group in enumerate(groups)
+    ]
+
+
+# small pastes are compiled right away, big ones are sent to a pool of processes
+# so they don't hold the GIL (and every other request in this process) for long.
+# a paste which doesn't compile in `timeout` seconds is shown as plain text instead.
+# only as many pastes as there are processes are sent at once, so the time a paste
+# waits for a process doesn't count towards its `timeout`, only compiling it does
+#
+# with a `blocks` cache pastes are compiled block by block and every compiled block
+# is cached, so editing a paste only compiles the blocks which changed and only
+# those count towards `inline_limit`
+class CompileService:
+    def __init__(self, inline_limit: int, processes: int, threads: int, timeout: float, blocks=None):
+        self.inline_limit = inline_limit
+        self.processes = processes
+        self.timeout = timeout
+        self.blocks = blocks
+
+        # async views compile small pastes in these threads, so they don't block the event loop
+        self.threads = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="compile")
+
+        self._pool: ProcessPoolExecutor | None = None
+        self._lock = threading.Lock()
+        self._slots = threading.Semaphore(processes)  # free processes
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                # forking this process could copy locks other threads hold into the
+                # children, so they come from a server which only imported the compiler
+                context = multiprocessing.get_context("forkserver")
+                context.set_forkserver_preload(["myapp.modules.markdown"])
+                self._pool = ProcessPoolExecutor(max_workers=self.processes, mp_context=context)
+                # start every process now and not when the first big paste comes in
+                for _ in range(self.processes):
+                    self._pool.submit(int)
+            return self._pool
+
+    # a job which is already running can't be cancelled, so the processes are killed
+    # and a new pool is started. other jobs in the old pool get retried in the new one
+    def _kill_pool(self, pool: ProcessPoolExecutor):
+        with self._lock:
+            if self._pool is not pool:
+                return
+            self._pool = None
+
+        for process in list(pool._processes.values()):
+            process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _give_up(self, pool: ProcessPoolExecutor, content: str):
+        logger.warning(
+            "compiling a paste of %d characters took longer than %.1fs, showing it as plain text",
+            len(content), self.timeout
+        )
+        self._kill_pool(pool)
+
+    # `fn(arg)` right here or in the pool, depending on `size`. none if it took too long
+    def _run(self, fn, arg, size: int, content: str):
+        if size <= self.inline_limit:
+            return fn(arg)
+
+        for _ in range(2):
+            with self._slots:
+                pool = self._get_pool()
+                try:
+                    return pool.submit(fn, arg).result(timeout=self.timeout)
+                except TimeoutError:
+                    return self._give_up(pool, content)
+                except BrokenProcessPool:
+                    # some other paste got its pool killed
+                    self._kill_pool(pool)
+
+        logger.error("compile processes keep dying, showing a paste of %d characters as plain text", len(content))
+        return None
+
+    async def _arun(self, fn, arg, size: int, content: str):
+        loop = asyncio.get_running_loop()
+        if size <= self.inline_limit:
+            return await loop.run_in_executor(self.threads, fn, arg)
+
+        for _ in range(2):
+            # polls instead of blocking the event loop, a cancelled paste can't take a process
+            while not self._slots.acquire(blocking=False):
+                await asyncio.sleep(0.005)
+            try:
+                pool = self._get_pool()
+                try:
+                    return await asyncio.wait_for(loop.run_in_executor(pool, fn, arg), self.timeout)
+                except asyncio.TimeoutError:
+                    return self._give_up(pool, content)
+                except BrokenProcessPool:
+                    self._kill_pool(pool)
+            finally:
+                self._slots.release()
+
+        logger.error("compile processes keep dying, showing a paste of %d characters as plain text", len(content))
+        return None
+
+    # the html of `content` and the compiler version it was made with,
+    # which is `PLAIN_VERSION` if it took too long and is only plain text
+    def compile(self, content: str) -> tuple[str, int]:
+        with timed("compile_md"):
+            compiled = self._compile(content)
+        return (compiled, COMPILER_VERSION) if compiled is not None else (compile_plain(content), PLAIN_VERSION)
+
+    async def acompile(self, content: str) -> tuple[str, int]:
+        with timed("compile_md"):
+            compiled = await self._acompile(content)
+        return (compiled, COMPILER_VERSION) if compiled is not None else (compile_plain(content), PLAIN_VERSION)
+
+    def _compile(self, content: str) -> str | None:
+        if self.blocks is None:
+            return self._run(compile_paste, content, len(content), content)
+
+        groups = _split_groups(content)
+        compiled = self.blocks.get_many([key for key, _, _ in groups])
+
+        missing = {key: (group, last) for key, group, last in groups if key not in compiled}
+        if missing:
+            new = self._run(
+                compile_blocks, list(missing.values()), sum(len(group) for group, _ in missing.values()), content
+            )
+            if new is None:
+                return None
+
+            new = dict(zip(missing, new))
+            self.blocks.set_many(_get_cacheable(new, missing))
+            compiled.update(new)
+
+        return "".join(compiled[key] for key, _, _ in groups)
+
+    async def _acompile(self, content: str) -> str | None:
+        if self.blocks is None:
+            return await self._arun(compile_paste, content, len(content), content)
+
+        groups = await asyncio.get_running_loop().run_in_executor(self.threads, _split_groups, content)
+        compiled = await self.blocks.aget_many([key for key, _, _ in groups])
+
+        missing = {key: (group, last) for key, group, last in groups if key not in compiled}
+        if missing:
+            new = await self._arun(
+                compile_blocks, list(missing.values()), sum(len(group) for group, _ in missing.values()), content
+            )
+            if new is None:
+                return None
+
+            new = dict(zip(missing, new))
+            await self.blocks.aset_many(_get_cacheable(new, missing))
+            compiled.update(new)
+
+        return "".join(compiled[key] for key, _, _ in groups)
+
+
+compile_service = CompileService(
+    settings.COMPILE_INLINE_LIMIT, settings.COMPILE_PROCESSES, settings.COMPILE_THREADS, settings.COMPILE_TIMEOUT,
+    caches[settings.COMPILE_BLOCK_CACHE] if settings.COMPILE_BLOCK_CACHE else None
+)
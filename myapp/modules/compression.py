@@ -0,0 +1,97 @@
+import re
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional
+    zstandard = None
+
+# the first byte of every stored value says how the rest of it is stored
+PLAIN = 0
+ZLIB = 1
+ZSTD = 2
+# raw deflate ending in a sync flush, with the crc32 and size of the text before it. it can
+# be put into the middle of a gzip stream as is, see `gzip_around`
+DEFLATE = 3
+
+CODECS = {'none': PLAIN, 'zlib': ZLIB, 'zstd': ZSTD, 'deflate': DEFLATE}
+
+_DEFLATE_HEADER = struct.Struct('<II')
+# a gzip member without a name, mtime or any flags
+_GZIP_HEADER = b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff'
+_ZEROS = memoryview(bytes(64 * 1024))
+
+_re_accepts_gzip = re.compile(r'\bgzip\b')
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    return _re_accepts_gzip.search(accept_encoding) is not None
+
+
+def compress(s: str, codec: int, level: int = 6) -> bytes:
+    data = s.encode('utf-8')
+    if codec == PLAIN:
+        return bytes((PLAIN,)) + data
+    if codec == ZLIB:
+        return bytes((ZLIB,)) + zlib.compress(data, level)
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError("zstd compression needs the `zstandard` package")
+        return bytes((ZSTD,)) + zstandard.ZstdCompressor(level=level).compress(data)
+    if codec == DEFLATE:
+        return bytes((DEFLATE,)) + _DEFLATE_HEADER.pack(zlib.crc32(data), len(data) & 0xffffffff) \
+            + _deflate(data, level, zlib.Z_SYNC_FLUSH)
+    raise ValueError(f"unknown codec {codec}")
+
+
+def decompress(value: bytes) -> str:
+    codec, data = value[0], value[1:]
+    if codec == PLAIN:
+        return data.decode('utf-8')
+    if codec == ZLIB:
+        return zlib.decompress(data).decode('utf-8')
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError("this value is compressed with zstd, which needs the `zstandard` package")
+        return zstandard.ZstdDecompressor().decompress(data).decode('utf-8')
+    if codec == DEFLATE:
+        return zlib.decompressobj(-zlib.MAX_WBITS).decompress(data[_DEFLATE_HEADER.size:]).decode('utf-8')
+    raise ValueError(f"unknown codec {codec}")
+
+
+def _deflate(data: bytes, level: int, flush: int) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(flush)
+
+
+# crc32 of `a + b` out of the crc32 of both and the size of `b`, crc32 being
+# linear means that's crc32 of `a` followed by as many zeros as `b` is long,
+# xor crc32 of just those zeros, xor crc32 of `b`
+def _crc32_combine(crc_a: int, crc_b: int, size_b: int) -> int:
+    zeros_after_a, zeros = crc_a, 0
+    while size_b > 0:
+        chunk = _ZEROS[:size_b]
+        zeros_after_a, zeros = zlib.crc32(chunk, zeros_after_a), zlib.crc32(chunk, zeros)
+        size_b -= len(chunk)
+    return zeros_after_a ^ zeros ^ crc_b
+
+
+# a whole gzip body of `head`, the stored value and `tail`, without decompressing the stored
+# value. none if it isn't stored as `DEFLATE`
+def gzip_around(head: bytes, value: bytes, tail: bytes, level: int = 6) -> bytes | None:
+    if not value or value[0] != DEFLATE:
+        return None
+
+    crc, size = _DEFLATE_HEADER.unpack_from(value, 1)
+    crc = _crc32_combine(_crc32_combine(zlib.crc32(head), crc, size), zlib.crc32(tail), len(tail))
+    size = (len(head) + size + len(tail)) & 0xffffffff
+
+    # every part is deflated by itself, so nothing points back into another one
+    return b"".join((
+        _GZIP_HEADER,
+        _deflate(head, level, zlib.Z_SYNC_FLUSH),
+        value[1 + _DEFLATE_HEADER.size:],
+        _deflate(tail, level, zlib.Z_FINISH),
+        _DEFLATE_HEADER.pack(crc, size),
+    ))
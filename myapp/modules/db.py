@@ -0,0 +1,64 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from .timing import time_query
+
+# whether reads of the current request have to go to the primary and whether it wrote anything,
+# none outside of requests (see `myapp.middleware.replica_middleware`)
+_primary: ContextVar[dict[str, bool] | None] = ContextVar("primary", default=None)
+
+
+# runs on every new connection, sqlite keeps most pragmas per connection only
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite' or not settings.SQLITE_PRAGMAS:
+        return
+
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+# counts the time spent in queries of every request, for `Server-Timing`.
+# connections which reconnect are created again with the same wrappers
+def time_queries(sender, connection, **kwargs):
+    if settings.REQUEST_TIMING and time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
+
+
+def start_routing(pinned: bool) -> tuple[dict[str, bool], object]:
+    state = {'pinned': pinned, 'wrote': False}
+    return state, _primary.set(state)
+
+
+def stop_routing(token):
+    _primary.reset(token)
+
+
+# writes go to the primary (`default`), reads of requests go to a random replica unless the
+# request writes or wrote anything lately, so nobody misses their own changes while the
+# replicas catch up. anything outside of requests (commands, shells) only uses the primary
+class ReplicaRouter:
+    def __init__(self, replicas: list[str] | None = None):
+        self.replicas = replicas if replicas is not None else \
+            [f"replica_{i}" for i in range(len(settings.DB_REPLICAS))]
+
+    def db_for_read(self, model, **hints):
+        state = _primary.get()
+        if state is None or state['pinned'] or not self.replicas:
+            return DEFAULT_DB_ALIAS
+        return random.choice(self.replicas)
+
+    def db_for_write(self, model, **hints):
+        state = _primary.get()
+        if state is not None:
+            state['pinned'] = state['wrote'] = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # every db has the same rows, sooner or later
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS  # replicas get the tables from the primary
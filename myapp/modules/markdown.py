@@ -1,18 +1,26 @@
-# needed for sorting
-def _get_item_len(item):
-    return len(item)
+import re
+from bisect import bisect_right
+from itertools import accumulate
+from types import MappingProxyType
+from typing import Iterator, NamedTuple
 
-def _get_unique_items(items, allow_none: bool = True):
-    unique_items = []
+from django.utils.html import escape
 
-    for item in items:
-        if not allow_none and item is None:
-            continue
 
-        if item not in unique_items:
-            unique_items.append(item)
+# bump this whenever the compiled html changes,
+# pastes compiled by an older version are recompiled when they are viewed
+COMPILER_VERSION = 1
 
-    return unique_items
+# `compile_md` ends every markdown (and every nested span) with a break line
+_TRAILING_BREAK = '\r\n\r\n'
+
+# spans nested deeper than this are left as they are instead of being compiled
+MAX_NESTING_DEPTH = 128
+
+
+# unique items in the order they first appear in
+def _get_unique_items(items, allow_none: bool = True) -> list:
+    return [item for item in dict.fromkeys(items) if allow_none or item is not None]
 
 
 # just a shorthand
@@ -20,161 +28,363 @@ def _join(s: list[str] | tuple[str]) -> str:
     return "".join(s)
 
 
-def _contains_potential_tokens(raw_md: str, symbols: list[str] | tuple[str]) -> bool:
-    for symbol in symbols:
-        if symbol in raw_md:
-            return True
+def _compile_symbols_pattern(symbols: list[str] | tuple[str]) -> re.Pattern:
+    return re.compile(f"({'|'.join(re.escape(symbol) for symbol in symbols)})")
 
-    return False
 
+# positions of every closing symbol, used to pair opening symbols in one pass.
+# lookups only ever move forward, so every position is stepped over once
+class _ClosingIndex:
+    def __init__(self, raw_tokens: list[str], closings: tuple[str]):
+        self.positions: dict[str, list[int]] = {closing: [] for closing in closings}
+        self.cursors: dict[str, int] = dict.fromkeys(self.positions, 0)
 
-class Token:
-    def __init__(self, raw_opening: str, raw_closing: str | None, compiled_opening: str, compiled_closing: str | None, enclosed: bool):
-        self.raw: dict[str, str] = {
-            'opening': raw_opening,
-            'closing': raw_closing
-        }
-        self.compiled: dict[str, str] = {
-            'opening': compiled_opening,
-            'closing': compiled_closing
-        }
-        self.enclosed = enclosed
+        for i, raw_token in enumerate(raw_tokens):
+            if raw_token in self.positions:
+                self.positions[raw_token].append(i)
 
-    def get_compiled(self, s: str) -> str:
-        return f"{self.compiled['opening']}" \
-               f"{s if self.enclosed else ''}" \
-               f"{self.compiled['closing'] if self.compiled['closing'] is not None else ''}"
+    # position of the first `closing` after `i`, if there is one
+    def find(self, closing: str, i: int) -> int | None:
+        positions, cursor = self.positions[closing], self.cursors[closing]
+        while cursor < len(positions) and positions[cursor] <= i:
+            cursor += 1
+        self.cursors[closing] = cursor
 
+        return positions[cursor] if cursor < len(positions) else None
 
-class MarkdownCompiler:
-    def __init__(self):
-        self.tokens: list[Token] = []
 
-    def add_token(self, token: Token):
-        self.tokens.append(token)
+# a piece of split markdown which is compiled on its own: the tokens of the
+# top level markdown between `start` and `end`, followed by `tail`.
+# nested spans get their own tail since their end is split again
+class _Span:
+    __slots__ = ('start', 'end', 'tail', 'length', 'last_opening', 'token', 'depth', 'i')
 
-    def compile(self, raw_md: str) -> str:
-        # split.
+    def __init__(
+        self, start: int, end: int, tail: list[str], token: "Token | None" = None, depth: int = 0,
+        open_end: bool = False
+    ):
+        self.start, self.end, self.tail = start, end, tail
+        self.length = end - start + len(tail)
+        self.token, self.depth = token, depth
 
-        # this step will split up raw markdown
-        # ie «text can be **bold** btw» will turn into
-        # ["text can be ", "**", "bold", "**", " btw"]
-        # it is just easier like this
+        # no token can open in the last two tokens, unless
+        # the span is a block and the markdown goes on after it
+        self.last_opening = self.length if open_end else self.length - 3
 
-        # the thing that will store splitted markdown
-        raw_tokens: list[str] = []
+        # where we are in the span
+        self.i = 0
 
-        # get all unique symbols which are used for tokens
-        # sorted from largest to smallest
-        # we need this in order for it not to split up
-        # a bigger token with a smaller one0
-        unique_symbols = _get_unique_items(
-            [token.raw['opening'] for token in self.tokens] + [token.raw['closing'] for token in self.tokens],
-            allow_none=False
+
+# split markdown together with everything needed to compile
+# nested spans out of it without splitting it again
+class _TokenStream:
+    def __init__(self, compiler: "MarkdownCompiler", raw_tokens: list[str]):
+        self.compiler = compiler
+        self.raw_tokens = raw_tokens
+        self.closings = _ClosingIndex(raw_tokens, compiler.closings)
+
+        # where every token starts and how many symbols come before it
+        self.offsets = [0, *accumulate(map(len, raw_tokens))]
+        self.symbol_counts = [0, *accumulate(map(compiler.symbols.__contains__, raw_tokens))]
+
+    def get(self, span: _Span, i: int) -> str:
+        i += span.start
+        return self.raw_tokens[i] if i < span.end else span.tail[i - span.end]
+
+    # tokens of the span from `i` up to `j` as a top level range and a tail
+    def slice(self, span: _Span, i: int, j: int) -> tuple[int, int, list[str]]:
+        root_length = span.end - span.start
+        return (
+            span.start + min(i, root_length), span.start + min(j, root_length),
+            span.tail[max(i - root_length, 0):max(j - root_length, 0)]
         )
-        unique_symbols.sort(reverse=True, key=_get_item_len)
-
-        # we will be checking at every point
-        # if next symbols match any of the symbols
-        buffer, skip = "", 0
-        for i in range(len(raw_md)):
-            if skip: skip -= 1; continue  # NOQA E702
-
-            match_found = False
-            for unique_symbol in unique_symbols:
-                if raw_md[i:i + len(unique_symbol)] == unique_symbol:
-                    if buffer:
-                        raw_tokens.append(buffer)
-                        buffer = ""
-
-                    raw_tokens.append(unique_symbol)
-                    skip = len(unique_symbol) - 1
-                    match_found = True
+
+    def join(self, span: _Span, i: int, j: int) -> str:
+        start, end, tail = self.slice(span, i, j)
+        return _join(self.raw_tokens[start:end]) + _join(tail) if tail else _join(self.raw_tokens[start:end])
+
+    def has_symbols(self, span: _Span, i: int, j: int) -> bool:
+        start, end, tail = self.slice(span, i, j)
+        return self.symbol_counts[end] > self.symbol_counts[start] \
+            or any(raw_token in self.compiler.symbols for raw_token in tail)
+
+    # position of the first `closing` in the span after `i`, if there is one
+    def find_closing(self, span: _Span, closing: str, i: int) -> int | None:
+        root_length = span.end - span.start
+        if i < root_length:
+            closing_i = self.closings.find(closing, span.start + i)
+            if closing_i is not None and closing_i < span.end:
+                return closing_i - span.start
+            i = root_length - 1
+
+        for k in range(i - root_length + 1, len(span.tail)):
+            if span.tail[k] == closing:
+                return root_length + k
+
+        return None
+
+    # the tokens between `i` and `j` as if they were split again with a trailing break line.
+    # splitting them again would give back the exact same tokens, except for the last few
+    # characters which can now form a bigger symbol together with the break line, so
+    # only those are split again
+    def nested(self, span: _Span, i: int, j: int, token: "Token") -> _Span:
+        start, end, tail = self.slice(span, i, j)
+        length = self.offsets[end] - self.offsets[start] + sum(len(raw_token) for raw_token in tail)
+
+        # the first character which could be a part of a symbol running into the break line
+        unsafe = length - self.compiler.longest_symbol + 1
+        if unsafe <= 0:
+            return _Span(start, start, self.compiler.split(self.join(span, i, j) + _TRAILING_BREAK), token, span.depth + 1)
+
+        # find the token `unsafe` falls into
+        if unsafe < self.offsets[end] - self.offsets[start]:
+            k = bisect_right(self.offsets, self.offsets[start] + unsafe, start, end) - 1
+            k_start = self.offsets[k] - self.offsets[start]
+            k -= start
+        else:
+            k, k_start = end - start, self.offsets[end] - self.offsets[start]
+            for raw_token in tail:
+                if k_start + len(raw_token) > unsafe:
                     break
-            if not match_found:
-                buffer += raw_md[i]
+                k, k_start = k + 1, k_start + len(raw_token)
+
+        tokens = self.raw_tokens[start + k:end] + tail[max(k - (end - start), 0):]
+        raw_token = tokens[0]
+
+        if k_start != unsafe and raw_token in self.compiler.symbols:
+            # the symbol itself can't change, only whatever comes after it
+            keep, resume, prefix = k + 1, len(raw_token), ""
+        else:
+            keep, resume, prefix = k, unsafe - k_start, raw_token[:unsafe - k_start]
+
+        new_tail = self.compiler.split(raw_token[resume:] + _join(tokens[1:]) + _TRAILING_BREAK)
+        if prefix:
+            # text can't be followed by more text, it would have been a single token
+            if new_tail and new_tail[0] not in self.compiler.symbols:
+                new_tail[0] = prefix + new_tail[0]
+            else:
+                new_tail.insert(0, prefix)
+
+        root_length = end - start
+        return _Span(
+            start, start + min(keep, root_length), tail[:max(keep - root_length, 0)] + new_tail,
+            token, span.depth + 1
+        )
 
-        # match.
 
-        # here we
+# tokens are shared by every compilation, so they are plain immutable tuples
+class Token(NamedTuple):
+    raw_opening: str
+    raw_closing: str | None
+    compiled_opening: str
+    compiled_closing: str | None
+    enclosed: bool
 
-        html, skip = "", 0
+    def get_compiled(self, s: str) -> str:
+        return f"{self.compiled_opening}" \
+               f"{s if self.enclosed else ''}" \
+               f"{self.compiled_closing if self.compiled_closing is not None else ''}"
 
 
-        for i in range(len(raw_tokens)):
-            if skip: skip -= 1; continue  # NOQA E702
+# everything derived from the grammar is built once here and never changed
+# afterwards, so a single compiler can be shared between threads
+class MarkdownCompiler:
+    def __init__(self, tokens: list[Token] | tuple[Token], max_depth: int = MAX_NESTING_DEPTH):
+        self.tokens: tuple[Token] = tuple(tokens)
+        self.max_depth = max_depth
 
-            match_found = False
+        # get all unique symbols which are used for tokens
+        # sorted from largest to smallest
+        # we need this in order for it not to split up
+        # a bigger token with a smaller one
+        unique_symbols = _get_unique_items(
+            [token.raw_opening for token in self.tokens] + [token.raw_closing for token in self.tokens],
+            allow_none=False
+        )
+        unique_symbols.sort(reverse=True, key=len)
+        self.unique_symbols: tuple[str] = tuple(unique_symbols)
+        self.symbols: frozenset[str] = frozenset(unique_symbols)
+        self.longest_symbol = len(unique_symbols[0]) if unique_symbols else 1
+
+        # every symbol is tried in one alternation, largest first, so at
+        # any position the longest symbol wins just like it would when
+        # checking them one by one
+        self.symbols_pattern = _compile_symbols_pattern(self.unique_symbols)
+
+        # which tokens can start at which symbol, in the order they were given
+        openings: dict[str, list[Token]] = {}
+        for token in self.tokens:
+            openings.setdefault(token.raw_opening, []).append(token)
+        self.openings = MappingProxyType({opening: tuple(tokens) for opening, tokens in openings.items()})
+
+        self.closings: tuple[str] = tuple(_get_unique_items(
+            [token.raw_closing for token in self.tokens], allow_none=False
+        ))
+
+    def split(self, raw_md: str) -> list[str]:
+        # this step will split up raw markdown
+        # ie «text can be **bold** btw» will turn into
+        # ["text can be ", "**", "bold", "**", " btw"]
+        # it is just easier like this
 
-            for token in self.tokens:
-                # if there can't be any possible tokens left
-                # just stop trying to match any tokens
-                if i + 3 > len(raw_tokens):
+        # splitting on a capturing group keeps the symbols themselves,
+        # empty strings between them are dropped
+        return [raw_token for raw_token in self.symbols_pattern.split(raw_md) if raw_token]
+
+    # splits markdown into blocks at break lines no token runs over. compiling each of
+    # them by itself gives the same html as compiling all of it at once, as long as
+    # every block but the last one is compiled with `open_end`.
+    # this only goes over the top level tokens, without compiling anything
+    def split_blocks(self, raw_md: str) -> list[str]:
+        raw_tokens = self.split(raw_md)
+        closings = _ClosingIndex(raw_tokens, self.closings)
+        length = len(raw_tokens)
+
+        boundaries = [0]
+        offset, i = 0, 0
+        while i < length:
+            raw_token = raw_tokens[i]
+            if raw_token == _TRAILING_BREAK and i + 3 <= length:
+                boundaries.append(offset)
+
+            j = 0
+            for token in self.openings.get(raw_token, ()) if i + 3 <= length else ():
+                if token.raw_closing is None:
                     break
-
-                if raw_tokens[i] == token.raw['opening']:
-                    j = 0
-                    if token.raw['closing'] is not None:
-                        j, invalid = 1, False
-                        while raw_tokens[i+j] != token.raw['closing']:
-                            j += 1
-                            if i+j >= len(raw_tokens):
-                                invalid = True; break  # NOQA E702
-                        if invalid:
-                            continue
-
-                    token_content = _join(raw_tokens[i+1:i+j])
-
-                    # if token contents themselves contain uncompiled markdown
-                    # it is time for the oldest trick in the book: recursive function
-                    # unfortunately this does mean it may give up if it will go too recursive
-                    if _contains_potential_tokens(token_content, unique_symbols):
-                        token_content = compile_md(token_content)
-
-                    html += token.get_compiled(token_content)
-                    skip = j
-                    match_found = True
+                closing_i = closings.find(token.raw_closing, i)
+                if closing_i is not None:
+                    j = closing_i - i
                     break
 
-            if not match_found:
-                html += raw_tokens[i]
+            offset += sum(map(len, raw_tokens[i:i + j + 1])) if j else len(raw_token)
+            i += j + 1
 
+        boundaries.append(len(raw_md))
+        return [raw_md[start:end] for start, end in zip(boundaries, boundaries[1:]) if end > start]
 
-        return html
+    def compile(self, raw_md: str, max_depth: int | None = None, open_end: bool = False) -> str:
+        return _join(self.compile_iter(raw_md, max_depth, open_end))
 
+    # same as `compile`, but gives out html bit by bit as soon as it is compiled
+    def compile_iter(self, raw_md: str, max_depth: int | None = None, open_end: bool = False) -> Iterator[str]:
+        if max_depth is None:
+            max_depth = self.max_depth
 
-def compile_md(raw_markdown: str) -> str:
-    compiler = MarkdownCompiler()
+        # split.
+
+        stream = _TokenStream(self, self.split(raw_md))
+
+        # match.
+
+        # here we go over the split markdown once and replace every
+        # opening symbol (and everything up to its closing one) with html.
+
+        # if token contents themselves contain uncompiled markdown they are
+        # compiled as a span of their own. spans are kept on a stack instead
+        # of recursing and are cut out of the same split markdown, so no
+        # matter how deep it goes it is only split once
+        stack = [_Span(0, len(stream.raw_tokens), [], open_end=open_end)]
+        while True:
+            span = stack[-1]
+            i = span.i
+
+            if i >= span.length:
+                stack.pop()
+                if not stack:
+                    return
+
+                if span.token.compiled_closing is not None:
+                    yield span.token.compiled_closing
+                continue
+
+            raw_token = stream.get(span, i)
+
+            # if there can't be any possible tokens left
+            # just stop trying to match any tokens
+            candidates = self.openings.get(raw_token, ()) if i <= span.last_opening else ()
+
+            for token in candidates:
+                # instead of scanning forward from every opening symbol
+                # we look up where the next closing symbol is
+                j = 0
+                if token.raw_closing is not None:
+                    closing_i = stream.find_closing(span, token.raw_closing, i)
+                    if closing_i is None:
+                        continue
+                    j = closing_i - i
+
+                span.i = i + j + 1
+
+                if token.enclosed and span.depth < max_depth and stream.has_symbols(span, i + 1, i + j):
+                    yield token.compiled_opening
+                    stack.append(stream.nested(span, i + 1, i + j, token))
+                else:
+                    yield token.get_compiled(stream.join(span, i + 1, i + j))
+                break
+            else:
+                yield raw_token
+                span.i = i + 1
+
+
+def create_compiler() -> MarkdownCompiler:
+    tokens = []
 
     # headers
-    compiler.add_token(Token('# ', '\r\n\r\n', '<h1 style=\"font-size: 3.5rem\">', '</h1><br>', True))
-    compiler.add_token(Token('## ', '\r\n\r\n', '<h2 style=\"font-size: 2.25rem\">', '</h2><br>', True))
-    compiler.add_token(Token('### ', '\r\n\r\n', '<h3 style=\"font-size: 1.75rem\">', '</h3><br>', True))
-    compiler.add_token(Token('#### ', '\r\n\r\n', '<h4 style=\"font-size: 1.35rem\">', '</h4><br>', True))
-    compiler.add_token(Token('##### ', '\r\n\r\n', '<h5 style=\"font-size: 1.25rem\">', '</h5><br>', True))
-    compiler.add_token(Token('###### ', '\r\n\r\n', '<h6 style=\"font-size: 1.15rem\">', '</h6><br>', True))
+    tokens.append(Token('# ', '\r\n\r\n', '<h1 style=\"font-size: 3.5rem\">', '</h1><br>', True))
+    tokens.append(Token('## ', '\r\n\r\n', '<h2 style=\"font-size: 2.25rem\">', '</h2><br>', True))
+    tokens.append(Token('### ', '\r\n\r\n', '<h3 style=\"font-size: 1.75rem\">', '</h3><br>', True))
+    tokens.append(Token('#### ', '\r\n\r\n', '<h4 style=\"font-size: 1.35rem\">', '</h4><br>', True))
+    tokens.append(Token('##### ', '\r\n\r\n', '<h5 style=\"font-size: 1.25rem\">', '</h5><br>', True))
+    tokens.append(Token('###### ', '\r\n\r\n', '<h6 style=\"font-size: 1.15rem\">', '</h6><br>', True))
 
     # text formatting
-    compiler.add_token(Token('*', '*', '<em>', '</em>', True))
-    compiler.add_token(Token('**', '**', '<strong>', '</strong>', True))
-    compiler.add_token(Token('__', '__', '<u>', '</u>', True))
-    compiler.add_token(Token('~~', '~~', '<s>', '</s>', True))
+    tokens.append(Token('*', '*', '<em>', '</em>', True))
+    tokens.append(Token('**', '**', '<strong>', '</strong>', True))
+    tokens.append(Token('__', '__', '<u>', '</u>', True))
+    tokens.append(Token('~~', '~~', '<s>', '</s>', True))
 
     # idk why but it fails to parse such thing by itself
     # so we have to register the thing separate manually
-    compiler.add_token(Token('***', '***', '<strong><em>', '</em></strong>', True))
+    tokens.append(Token('***', '***', '<strong><em>', '</em></strong>', True))
 
     # text align
     # we have to escape `<` and `>` as in HTML since the input is gonna be escaped, so we have to escape here too
-    compiler.add_token(Token('-&gt;', '-&gt;', '<div style=\"text-align: right;\">', '</div>', True))
-    compiler.add_token(Token('-&gt;', '&lt;-', '<div style=\"text-align: center;\">', '</div>', True))
+    tokens.append(Token('-&gt;', '-&gt;', '<div style=\"text-align: right;\">', '</div>', True))
+    tokens.append(Token('-&gt;', '&lt;-', '<div style=\"text-align: center;\">', '</div>', True))
 
     # horizontal rule
-    compiler.add_token(Token('\r\n---\r\n', None, '<hr>', None, False))
-    compiler.add_token(Token('\r\n***\r\n', None, '<hr>', None, False))
+    tokens.append(Token('\r\n---\r\n', None, '<hr>', None, False))
+    tokens.append(Token('\r\n***\r\n', None, '<hr>', None, False))
 
     # newline
-    compiler.add_token(Token('\r\n\r\n', None, '<br>', None, False))
-    compiler.add_token(Token('\r\n', None, ' ', None, False))
+    tokens.append(Token('\r\n\r\n', None, '<br>', None, False))
+    tokens.append(Token('\r\n', None, ' ', None, False))
+
+    return MarkdownCompiler(tokens)
+
+
+# the grammar never changes, so it is only built once on import
+_compiler = create_compiler()
+
+
+def compile_md(raw_markdown: str, max_depth: int | None = None) -> str:
+    return _join(compile_md_iter(raw_markdown, max_depth))
+
+
+def compile_md_iter(raw_markdown: str, max_depth: int | None = None) -> Iterator[str]:
+    return _compiler.compile_iter(raw_markdown + _TRAILING_BREAK, max_depth)  # we have to add the token for break line manually as it gets stripped
+
+
+# pastes are escaped before they are compiled, the grammar relies on that
+def compile_paste(content: str) -> str:
+    return compile_md(escape(content))
+
+
+# the paste (escaped, with the trailing break line) split into blocks which can be compiled one by one
+def split_paste(content: str) -> list[str]:
+    return _compiler.split_blocks(escape(content) + _TRAILING_BREAK)
+
 
-    return compiler.compile(raw_markdown + '\r\n\r\n')  # we have to add the token for break line manually as it gets stripped
+# compiles blocks from `split_paste`, `last` tells if a block is the last one of its paste
+def compile_blocks(blocks: list[tuple[str, bool]]) -> list[str]:
+    return [_compiler.compile(block, open_end=not last) for block, last in blocks]
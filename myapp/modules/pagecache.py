@@ -0,0 +1,231 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, NamedTuple
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from .singleflight import AsyncSingleFlight, SingleFlight
+
+
+class CachedPage(NamedTuple):
+    version: str  # changes whenever the page does
+    etag: str
+    last_modified: int
+    body: bytes
+    expires_at: float | None = None  # timestamp the paste expires at
+
+    def is_expired(self) -> bool:
+        return self.expires_at is not None and self.expires_at <= time.time()
+
+
+# least recently used pages get thrown out first, once all of them
+# together take up more than `max_bytes`. `size` tells how much a page takes up
+class ByteLRU:
+    def __init__(self, max_bytes: int, size: Callable[[Any], int] = lambda page: len(page.body)):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._size = size
+
+        self._pages: OrderedDict[tuple, CachedPage] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> CachedPage | None:
+        with self._lock:
+            page = self._pages.get(key)
+            if page is not None:
+                self._pages.move_to_end(key)
+            return page
+
+    def set(self, key: tuple, page: CachedPage):
+        # one page should never push out everything else
+        if self._size(page) > self.max_bytes // 4:
+            return
+
+        with self._lock:
+            self._delete(key)
+            self._pages[key] = page
+            self.size += self._size(page)
+
+            while self.size > self.max_bytes:
+                _, evicted = self._pages.popitem(last=False)
+                self.size -= self._size(evicted)
+
+    def delete(self, key: tuple):
+        with self._lock:
+            self._delete(key)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self.size = 0
+
+    def _delete(self, key: tuple):
+        page = self._pages.pop(key, None)
+        if page is not None:
+            self.size -= self._size(page)
+
+
+# every `ByteLRUCache` with the same location in this process shares one
+_lrus: dict[str, ByteLRU] = {}
+_lrus_lock = threading.Lock()
+
+
+# a django cache backend keeping strings in a `ByteLRU`, so it is bounded by how many characters
+# it holds (`OPTIONS: {'MAX_BYTES': ...}`) and not by how many of them. nothing times out,
+# values stay until they are pushed out
+class ByteLRUCache(BaseCache):
+    def __init__(self, location: str, params: dict):
+        super().__init__(params)
+        with _lrus_lock:
+            if location not in _lrus:
+                _lrus[location] = ByteLRU(int(params.get('OPTIONS', {}).get('MAX_BYTES', 16 << 20)), len)
+            self._values = _lrus[location]
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None) -> bool:
+        if self.has_key(key, version):
+            return False
+        self.set(key, value, timeout, version)
+        return True
+
+    def get(self, key, default=None, version=None):
+        value = self._values.get(self.make_and_validate_key(key, version))
+        return default if value is None else value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self._values.set(self.make_and_validate_key(key, version), value)
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None) -> bool:
+        return self.has_key(key, version)
+
+    def delete(self, key, version=None) -> bool:
+        key = self.make_and_validate_key(key, version)
+        found = self._values.get(key) is not None
+        self._values.delete(key)
+        return found
+
+    def has_key(self, key, version=None) -> bool:
+        return self._values.get(self.make_and_validate_key(key, version)) is not None
+
+    def clear(self):
+        self._values.clear()
+
+
+# rendered pages, kept in this process and optionally in a cache shared by
+# every process. pages in this process are only trusted as long as their
+# version is still the one in the shared cache, so invalidating a page in
+# one process invalidates it everywhere.
+# without a shared cache nothing tells this process about changes made by
+# the others, so the version is looked up with `get_version` (`aget_version`)
+# instead, which gives none for pages which are gone
+class PageCache:
+    def __init__(
+        self, max_bytes: int, shared=None, timeout: int | None = None,
+        get_version: Callable[[tuple], str | None] | None = None,
+        aget_version: Callable[[tuple], Awaitable[str | None]] | None = None
+    ):
+        self.local = ByteLRU(max_bytes)
+        self.shared = shared
+        self.timeout = timeout
+        self.get_version = get_version
+        self.aget_version = aget_version
+
+        self._renders = SingleFlight()
+        self._arenders = AsyncSingleFlight()
+
+    @staticmethod
+    def _get_shared_keys(key: tuple) -> tuple[str, str]:
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return f"opyn:page:{digest}", f"opyn:page-version:{digest}"
+
+    def get(self, key: tuple) -> CachedPage | None:
+        page = self.local.get(key)
+        if self.shared is None:
+            if page is not None and self.get_version is not None and self.get_version(key) != page.version:
+                self.local.delete(key)
+                return None
+            return page
+
+        page_key, version_key = self._get_shared_keys(key)
+        if page is not None:
+            if self.shared.get(version_key) == page.version:
+                return page
+            self.local.delete(key)
+
+        page = self.shared.get(page_key)
+        if page is not None:
+            self.local.set(key, page)
+        return page
+
+    # if a page isn't cached, only one thread renders it
+    # and everyone else asking for it waits for that one
+    def get_or_render(self, key: tuple, render: Callable[[], CachedPage]) -> CachedPage:
+        page = self.get(key)
+        if page is not None:
+            return page
+
+        def render_and_set() -> CachedPage:
+            page = render()
+            self.local.set(key, page)
+            if self.shared is not None:
+                page_key, version_key = self._get_shared_keys(key)
+                self.shared.set_many({page_key: page, version_key: page.version}, self.timeout)
+            return page
+
+        return self._renders.do(key, render_and_set)
+
+    def invalidate(self, *keys: tuple):
+        for key in keys:
+            self.local.delete(key)
+            if self.shared is not None:
+                self.shared.delete_many(self._get_shared_keys(key))
+
+    # invalidates the pages once more after `delay` seconds, in case someone
+    # rendered them again from a db replica which didn't have the change yet
+    def invalidate_later(self, delay: float, *keys: tuple):
+        timer = threading.Timer(delay, self.invalidate, keys)
+        timer.daemon = True
+        timer.start()
+
+    # async versions of the above, for async views
+
+    async def aget(self, key: tuple) -> CachedPage | None:
+        page = self.local.get(key)
+        if self.shared is None:
+            if page is not None and self.aget_version is not None and await self.aget_version(key) != page.version:
+                self.local.delete(key)
+                return None
+            return page
+
+        page_key, version_key = self._get_shared_keys(key)
+        if page is not None:
+            if await self.shared.aget(version_key) == page.version:
+                return page
+            self.local.delete(key)
+
+        page = await self.shared.aget(page_key)
+        if page is not None:
+            self.local.set(key, page)
+        return page
+
+    async def aget_or_render(self, key: tuple, render: Callable[[], Awaitable[CachedPage]]) -> CachedPage:
+        page = await self.aget(key)
+        if page is not None:
+            return page
+
+        async def render_and_set() -> CachedPage:
+            page = await render()
+            self.local.set(key, page)
+            if self.shared is not None:
+                page_key, version_key = self._get_shared_keys(key)
+                await self.shared.aset_many({page_key: page, version_key: page.version}, self.timeout)
+            return page
+
+        return await self._arenders.do(key, render_and_set)
+
+    async def ainvalidate(self, *keys: tuple):
+        for key in keys:
+            self.local.delete(key)
+            if self.shared is not None:
+                await self.shared.adelete_many(self._get_shared_keys(key))
@@ -0,0 +1,82 @@
+from django.conf import settings
+from django.db import connections
+from django.db.models.expressions import RawSQL
+
+# an sqlite fts5 table indexing the content of every paste, its rowid being the id of the
+# paste. it is contentless, so it doesn't keep a copy of the text and taking a paste
+# out of it needs the exact text it was indexed with
+TABLE = "myapp_paste_search"
+
+
+def is_enabled(alias: str) -> bool:
+    return settings.PASTE_SEARCH and connections[alias].vendor == 'sqlite'
+
+
+# every word of the query has to be in a paste, as is. fts5 query syntax is not let through,
+# so nobody gets an error out of an unbalanced quote
+def to_match(query: str) -> str:
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+# ids of `pastes` which are in the index
+def _get_indexed(cursor, pastes: list[tuple[int, str]]) -> set[int]:
+    indexed = set()
+    for i in range(0, len(pastes), 500):  # stays under the number of parameters sqlite takes
+        ids = [pk for pk, _ in pastes[i:i + 500]]
+        cursor.execute(f"SELECT rowid FROM {TABLE} WHERE rowid IN ({', '.join(['%s'] * len(ids))})", ids)
+        indexed.update(pk for pk, in cursor.fetchall())
+    return indexed
+
+
+# adds `(id, content)` of pastes, the ones which are already in the index are left as they are
+def index_pastes(alias: str, pastes: list[tuple[int, str]]):
+    if not is_enabled(alias) or not pastes:
+        return
+
+    with connections[alias].cursor() as cursor:
+        indexed = _get_indexed(cursor, pastes)
+        cursor.executemany(
+            f"INSERT INTO {TABLE} (rowid, content) VALUES (%s, %s)",
+            [paste for paste in pastes if paste[0] not in indexed]
+        )
+
+
+# takes out `(id, content)` of pastes, `content` being what they were indexed with
+def unindex_pastes(alias: str, pastes: list[tuple[int, str]]):
+    if not is_enabled(alias) or not pastes:
+        return
+
+    with connections[alias].cursor() as cursor:
+        indexed = _get_indexed(cursor, pastes)
+        cursor.executemany(
+            f"INSERT INTO {TABLE} ({TABLE}, rowid, content) VALUES ('delete', %s, %s)",
+            [paste for paste in pastes if paste[0] in indexed]
+        )
+
+
+def clear(alias: str):
+    with connections[alias].cursor() as cursor:
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('delete-all')")
+
+
+# ids of the newest pastes matching `query` with an id below `before`. fts5 walks its index
+# by rowid, so this stays fast no matter how many pastes match
+def search(alias: str, query: str, before: int | None = None, limit: int = 20) -> list[int]:
+    match = to_match(query)
+    if not is_enabled(alias) or not match:
+        return []
+
+    sql = f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s"
+    params = [match]
+    if before is not None:
+        sql += " AND rowid < %s"
+        params.append(before)
+
+    with connections[alias].cursor() as cursor:
+        cursor.execute(sql + " ORDER BY rowid DESC LIMIT %s", params + [limit])
+        return [pk for pk, in cursor.fetchall()]
+
+
+# ids of every paste matching `query`, to filter querysets with (`pk__in=matching(query)`)
+def matching(query: str) -> RawSQL:
+    return RawSQL(f"SELECT rowid FROM {TABLE} WHERE {TABLE} MATCH %s", (to_match(query),))
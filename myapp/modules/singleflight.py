@@ -0,0 +1,65 @@
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException | None = None
+
+
+# makes sure that only one thread does the same (expensive) thing at a time.
+# everyone else who asks for the same key while it is being done just waits
+# for it to finish and gets the same result
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: dict = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+
+# same thing for coroutines, waiting doesn't block the event loop. the work runs as its
+# own task, so whoever started it going away (a client disconnecting) doesn't cancel it
+# for everyone else waiting on it
+class AsyncSingleFlight:
+    def __init__(self):
+        self._calls: dict = {}
+
+    async def do(self, key, fn):
+        key = (asyncio.get_running_loop(), key)  # tasks can't be shared between event loops
+
+        call = self._calls.get(key)
+        if call is None:
+            call = self._calls[key] = asyncio.ensure_future(fn())
+            call.add_done_callback(lambda task: self._done(key, task))
+        return await asyncio.shield(call)
+
+    def _done(self, key, task: asyncio.Task):
+        del self._calls[key]
+        # nobody might be waiting for it anymore, that's fine
+        task.cancelled() or task.exception()
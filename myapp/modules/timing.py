@@ -0,0 +1,144 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.template.backends.django import DjangoTemplates
+
+# seconds spent in every phase of the current request, none outside of requests
+_timings: ContextVar[dict[str, float] | None] = ContextVar("timings", default=None)
+
+# upper bounds of histogram buckets in seconds, like the prometheus client ones
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+
+
+def start_timing() -> tuple[dict[str, float], object]:
+    timings = {}
+    return timings, _timings.set(timings)
+
+
+def stop_timing(token):
+    _timings.reset(token)
+
+
+@contextmanager
+def timed(phase: str):
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[phase] = timings.get(phase, 0.0) + time.perf_counter() - start
+
+
+# added to every db connection (see `apps`), only costs a context var lookup outside of requests
+def time_query(execute, sql, params, many, context):
+    if _timings.get() is None:
+        return execute(sql, params, many, context)
+
+    with timed("db"):
+        return execute(sql, params, many, context)
+
+
+class _TimedTemplate:
+    def __init__(self, template):
+        self.template = template
+
+    def render(self, context=None, request=None):
+        with timed("render"):
+            return self.template.render(context, request)
+
+    def __getattr__(self, name: str):
+        return getattr(self.template, name)
+
+
+# the django template backend, but counting the time spent rendering
+class TimedTemplates(DjangoTemplates):
+    def from_string(self, template_code):
+        return _TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return _TimedTemplate(super().get_template(template_name))
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float] = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+# histograms of how long requests (and their phases) took, per url name.
+# every process keeps its own, so scrape each process (or run only one)
+class RequestMetrics:
+    def __init__(self):
+        self.requests: dict[str, Histogram] = {}
+        self.phases: dict[tuple[str, str], Histogram] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, url_name: str, total: float, timings: dict[str, float]):
+        with self._lock:
+            histogram = self.requests.get(url_name)
+            if histogram is None:
+                histogram = self.requests[url_name] = Histogram()
+            histogram.observe(total)
+
+            for phase, seconds in timings.items():
+                histogram = self.phases.get((url_name, phase))
+                if histogram is None:
+                    histogram = self.phases[(url_name, phase)] = Histogram()
+                histogram.observe(seconds)
+
+    # prometheus text format
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            _render_histograms(
+                lines, "opyn_request_duration_seconds", "time from the request coming in to the response going out",
+                {(('url_name', url_name),): histogram for url_name, histogram in self.requests.items()}
+            )
+            _render_histograms(
+                lines, "opyn_request_phase_duration_seconds", "time requests spent in db, compile_md, hash_sha512 and render",
+                {
+                    (('url_name', url_name), ('phase', phase)): histogram
+                    for (url_name, phase), histogram in self.phases.items()
+                }
+            )
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _render_histograms(lines: list[str], name: str, description: str, histograms: dict[tuple, Histogram]):
+    lines.append(f"# HELP {name} {description}")
+    lines.append(f"# TYPE {name} histogram")
+    for labels, histogram in sorted(histograms.items()):
+        labels = ",".join(f'{label}="{_escape_label(value)}"' for label, value in labels)
+
+        count = 0
+        for bucket, bucket_count in zip(histogram.buckets, histogram.counts):
+            count += bucket_count
+            le = "+Inf" if bucket == float("inf") else repr(bucket)
+            lines.append(f'{name}_bucket{{{labels},le="{le}"}} {count}')
+        lines.append(f"{name}_sum{{{labels}}} {histogram.sum!r}")
+        lines.append(f"{name}_count{{{labels}}} {count}")
+
+
+request_metrics = RequestMetrics()
+
+
+def get_server_timing(timings: dict[str, float], total: float) -> str:
+    return ", ".join(
+        [f"{phase};dur={seconds * 1000:.3f}" for phase, seconds in timings.items()] + [f"total;dur={total * 1000:.3f}"]
+    )
@@ -2,11 +2,14 @@ import hashlib
 
 from django.conf import settings
 
+from .timing import timed
+
 
 # just an sha512 wrapper
 def hash_sha512(s: str, salted: bool = True) -> str:
-    return hashlib.sha512(
-        s.encode('utf-8') + settings.HASH_SALT.encode('utf-8') if salted else s.encode('utf-8')
-    ).hexdigest()
+    with timed("hash_sha512"):
+        return hashlib.sha512(
+            s.encode('utf-8') + settings.HASH_SALT.encode('utf-8') if salted else s.encode('utf-8')
+        ).hexdigest()
 
 
@@ -0,0 +1,384 @@
+# the parts of paste pages shared by `views` and `async_views`: the page cache and the
+# validators of pages, admission control and the checks of `create` and `edit` posts
+from datetime import datetime, timedelta
+from functools import wraps
+import random
+import secrets
+import string
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_slug
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.html import escape
+from django.utils.http import http_date, quote_etag
+
+from .fields import stored
+from .models import Paste
+from .modules.admission import ConcurrencyLimit, TokenBuckets, retry_after
+from .modules.compression import accepts_gzip, gzip_around
+from .modules.compilation import CURRENT_VERSIONS
+from .modules.pagecache import CachedPage, PageCache
+from .modules.utils import hash_sha512
+
+
+# pages only load the columns they need, both `content` and `compiled` can be up to a few hundred KiB.
+# `view` only needs `content` to recompile stale pastes, then it is loaded separately
+VIEW_FIELDS = ('blob', 'blob__compiled', 'blob__compiler_version', 'edited_date', 'expires_at')
+RAW_FIELDS = ('blob', 'blob__content', 'edited_date', 'expires_at')
+
+# the page around `body_name`, for pages the paste is streamed (or gzipped) into. it is rendered with a
+# new placeholder every time, the colon keeps it from being a paste url or anything else in the page
+def render_around(request, template_name: str, context: dict, body_name: str) -> tuple[str, str]:
+    placeholder = f"opyn:body:{secrets.token_hex(8)}"
+    return render_to_string(template_name, {**context, body_name: placeholder}, request).split(placeholder, 1)
+
+
+def in_chunks(s: str, escaped: bool = False):
+    for i in range(0, len(s), settings.STREAM_CHUNK_SIZE):
+        yield escape(s[i:i + settings.STREAM_CHUNK_SIZE]) if escaped else s[i:i + settings.STREAM_CHUNK_SIZE]
+
+
+# validators of a paste page. pages with the compiled paste also change whenever it
+# is compiled again, `compiler_version` is the one it was compiled with (none for the others)
+def get_validators(content_hash: str, edited_date: datetime, compiler_version: int | None) -> tuple[str, int]:
+    return (
+        quote_etag(f"{content_hash}-{compiler_version}" if compiler_version is not None else content_hash),
+        int(edited_date.timestamp())
+    )
+
+
+def set_validators(response, etag: str, last_modified: int):
+    response.headers.setdefault('ETag', etag)
+    response.headers.setdefault('Last-Modified', http_date(last_modified))
+    patch_cache_control(response, **settings.PASTE_CACHE_CONTROL)
+    return response
+
+
+def get_expiry(expires_at: datetime | None) -> float | None:
+    return expires_at.timestamp() if expires_at is not None else None
+
+
+def cache_page(paste: Paste, compiler_version: int | None, html: str) -> CachedPage:
+    etag, last_modified = get_validators(paste.blob_id, paste.edited_date, compiler_version)
+    return CachedPage(
+        f"{last_modified}:{etag}", etag, last_modified, html.encode('utf-8'), get_expiry(paste.expires_at)
+    )
+
+
+# cached pages outlive the pastes which expire
+def check_expiry(page: CachedPage) -> CachedPage:
+    if page.is_expired():
+        raise Http404
+    return page
+
+
+# validators of a paste page from what is stored, none for a `view` page
+# of a stale paste since the view compiles it again. `raw` and `plain` pages
+# only show the markdown, so they don't depend on the compiler
+def get_stored_validators(
+    kind: str, content_hash: str, edited_date: datetime, compiler_version: int
+) -> tuple[str, int] | None:
+    if kind in ("raw", "plain"):
+        return get_validators(content_hash, edited_date, None)
+    if compiler_version not in CURRENT_VERSIONS:
+        return None
+    return get_validators(content_hash, edited_date, compiler_version)
+
+
+# version a cached page of the paste would have now, none if it is gone or has to be compiled again
+def _get_page_version(kind: str, validators: tuple | None) -> str | None:
+    validators = get_stored_validators(kind, *validators) if validators is not None else None
+    if validators is None:
+        return None
+    etag, last_modified = validators
+    return f"{last_modified}:{etag}"
+
+
+def get_page_validators(paste_url: str):
+    return Paste.objects.unexpired().filter(url_name=paste_url) \
+        .values_list('blob', 'edited_date', 'blob__compiler_version')
+
+
+def _lookup_page_version(key: tuple) -> str | None:
+    kind, paste_url = key
+    return _get_page_version(kind, get_page_validators(paste_url).first())
+
+
+async def _alookup_page_version(key: tuple) -> str | None:
+    kind, paste_url = key
+    return _get_page_version(kind, await get_page_validators(paste_url).afirst())
+
+
+# rendered `view` and `raw` pages of the most viewed pastes. without a shared cache
+# every page is checked against the db with an indexed lookup before it is used,
+# so pages edited or deleted by other processes are not served
+page_cache = PageCache(
+    settings.PASTE_PAGE_CACHE_BYTES,
+    caches[settings.PASTE_PAGE_CACHE_BACKEND] if settings.PASTE_PAGE_CACHE_BACKEND else None,
+    settings.PASTE_PAGE_CACHE_TIMEOUT,
+    _lookup_page_version, _alookup_page_version
+)
+
+
+class NotDeflated(Exception):
+    pass
+
+
+def wants_gzip(request) -> bool:
+    return settings.SERVE_GZIP_PASTES and accepts_gzip(request.headers.get('Accept-Encoding', ''))
+
+
+# `view` query for `render_gzip_view`, stale pastes are left to the usual path to recompile them
+def get_gzip_view_query(paste_url: str):
+    return Paste.objects.unexpired().filter(url_name=paste_url, blob__compiler_version__in=CURRENT_VERSIONS) \
+        .annotate(stored_compiled=stored('blob__compiled')) \
+        .values_list('stored_compiled', 'blob', 'edited_date', 'expires_at', 'blob__compiler_version')
+
+
+# a gzipped `view` page with the stored `compiled` put into it as is, it is never decompressed
+def render_gzip_view(request, paste_url: str, paste: tuple | None) -> CachedPage:
+    if paste is None:
+        raise NotDeflated
+
+    stored_compiled, content_hash, edited_date, expires_at, compiler_version = paste
+    head, tail = render_around(request, "myapp/view.html", {'current_url': paste_url}, 'compiled')
+
+    body = gzip_around(head.encode('utf-8'), bytes(stored_compiled), tail.encode('utf-8'))
+    if body is None:
+        raise NotDeflated
+
+    etag, last_modified = get_validators(content_hash, edited_date, compiler_version)
+    return CachedPage(f"{last_modified}:{etag}", etag, last_modified, body, get_expiry(expires_at))
+
+
+# a 304 for a conditional request of a paste page, if it is one, with the validators the page
+# itself is sent with. `view` pages vary by `Accept-Encoding` and gzipped ones have a weak etag
+def get_not_modified(request, kind: str, etag: str, last_modified: int) -> HttpResponse | None:
+    if kind == "view" and wants_gzip(request):
+        etag = f"W/{etag}"
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        return None
+
+    if kind == "view":
+        patch_vary_headers(response, ('Accept-Encoding',))
+    return set_validators(response, etag, last_modified)
+
+
+def gzip_response(page: CachedPage) -> HttpResponse:
+    response = HttpResponse(page.body)
+    response.headers['Content-Encoding'] = "gzip"
+    patch_vary_headers(response, ('Accept-Encoding',))
+    # same page, different bytes
+    return set_validators(response, f"W/{page.etag}", page.last_modified)
+
+
+# admission control of `create` and `edit` posts, see `POST_RATE_LIMIT` and `POST_CONCURRENCY`
+
+post_buckets = TokenBuckets(settings.POST_RATE_LIMIT, settings.POST_BURST) if settings.POST_RATE_LIMIT else None
+post_slots = ConcurrencyLimit(settings.POST_CONCURRENCY, settings.POST_QUEUE_TIMEOUT) \
+    if settings.POST_CONCURRENCY else None
+
+
+def _get_client(request) -> str:
+    if settings.CLIENT_IP_HEADER and settings.CLIENT_IP_HEADER in request.headers:
+        return request.headers[settings.CLIENT_IP_HEADER].rsplit(",", 1)[-1].strip()
+    return request.META.get('REMOTE_ADDR', "")
+
+
+# a 429 for clients which posted too much lately
+def check_rate(request) -> HttpResponse | None:
+    if post_buckets is None:
+        return None
+    wait = post_buckets.take(_get_client(request))
+    return error_page(request, 429, wait) if wait else None
+
+
+def admitted(view_func):
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if request.method != "POST":
+            return view_func(request, *args, **kwargs)
+
+        response = check_rate(request)
+        if response is not None:
+            return response
+        if post_slots is None:
+            return view_func(request, *args, **kwargs)
+
+        # waiting for a slot would hold a thread which could be serving pages meanwhile,
+        # so posts which don't get one right away are told to come back later
+        if not post_slots.try_acquire():
+            return error_page(request, 429, post_slots.timeout)
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            post_slots.release()
+    return wrapper
+
+
+def aadmitted(view_func):
+    @wraps(view_func)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != "POST":
+            return await view_func(request, *args, **kwargs)
+
+        response = check_rate(request)
+        if response is not None:
+            return response
+        if post_slots is None:
+            return await view_func(request, *args, **kwargs)
+
+        if not await post_slots.aacquire():
+            return error_page(request, 503, post_slots.timeout)
+        try:
+            return await view_func(request, *args, **kwargs)
+        finally:
+            post_slots.release()
+    return wrapper
+
+
+# the parts of `create` and `edit` that don't touch the db, shared with their async versions
+
+# what the `expires_in` select of `create` can be set to, nothing meaning never
+EXPIRY_CHOICES = {
+    "": None,
+    "10m": timedelta(minutes=10),
+    "1h": timedelta(hours=1),
+    "1d": timedelta(days=1),
+    "1w": timedelta(weeks=1),
+    "30d": timedelta(days=30),
+}
+
+
+def prepare_create(post) -> tuple[str, str]:
+    content = post['content'].strip()
+    paste_url = post['paste_url'].strip()
+    if not paste_url:
+        paste_url = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+
+    return content, paste_url
+
+
+def validate_create(post, content: str, paste_url: str, url_taken: bool) -> list[str]:
+    error_messages = []
+    if len(content) > 262144:
+        error_messages.append(f"contents is too long ({len(content)} > 262144)")
+    elif len(content) < 1:
+        error_messages.append(f"contents are too short ({len(content)} < 1)")
+    if len(paste_url) > 256:
+        error_messages.append(f"paste url is too long ({len(paste_url)} > 256)")
+    if len(post['edit_code']) > 512:
+        error_messages.append(f"edit code is too long ({len(post['edit_code'])} > 512)")
+    elif len(post['edit_code']) < 1:
+        error_messages.append(f"edit code is too short ({len(post['edit_code'])} < 1)")
+    if url_taken:
+        error_messages.append(f"such url is already taken")
+    if post.get('expires_in', "") not in EXPIRY_CHOICES:
+        error_messages.append("unknown expiry")
+    try: validate_slug(paste_url)  # NOQA E702
+    except ValidationError:
+        error_messages.append("url must only contain letters, numbers, hyphens and underscores")
+
+    return error_messages
+
+
+def new_paste(post, paste_url: str) -> Paste:
+    edit_code = hash_sha512(post['edit_code'])
+
+    expires_in = EXPIRY_CHOICES[post.get('expires_in', "")]
+
+    creation_date = datetime.today()
+    return Paste(
+        url_name=paste_url,
+        edit_code=edit_code,
+        creation_date=creation_date,
+        edited_date=creation_date,
+        expires_at=timezone.now() + expires_in if expires_in is not None else None
+    )
+
+
+def prepare_edit(post) -> tuple[str, str]:
+    return post['new_content'].strip(), post['new_paste_url'].strip()
+
+
+def validate_edit(post, paste: Paste, new_content: str, new_paste_url: str, url_taken: bool) -> list[str]:
+    entered_edit_code = hash_sha512(post['edit_code'])
+
+    error_messages = []
+    if entered_edit_code != paste.edit_code:
+        error_messages.append(f"invalid edit code")
+    if len(new_content) > 262144:
+        error_messages.append(f"new contents are too long ({len(new_content)} > 262144)")
+    elif len(new_content) < 1:
+        error_messages.append(f"new contents are too short ({len(new_content)} < 1)")
+    if len(new_paste_url) > 256:
+        error_messages.append(f"new paste url is too long ({len(new_paste_url)} > 256)")
+    if len(post['new_edit_code']) > 512:
+        error_messages.append(f"new edit code is too long ({len(post['new_edit_code'])} > 512)")
+    if url_taken:
+        error_messages.append(f"such new url is already taken")
+    if new_paste_url:
+        try:
+            validate_slug(new_paste_url)
+        except ValidationError:
+            error_messages.append("new url must only contain letters, numbers, hyphens and underscores")
+
+    return error_messages
+
+
+def apply_edit(post, paste: Paste, new_paste_url: str):
+    if new_paste_url:
+        paste.url_name = new_paste_url
+    if post['new_edit_code']:
+        paste.edit_code = hash_sha512(post['new_edit_code'])
+    paste.edited_date = datetime.today()
+
+
+# the old pages are not valid anymore, neither under the old url nor under the new one
+def get_edited_pages(paste_url: str, new_paste_url: str) -> list[tuple]:
+    return [
+        (kind, url) for url in (paste_url, new_paste_url) for kind in ("view", "view.gz", "raw")
+    ]
+
+
+# how many pastes `search_pastes` lists at once
+SEARCH_PAGE_SIZE = 20
+
+
+def get_search_params(request) -> tuple[str, int | None]:
+    before = request.GET.get('before', "")
+    return request.GET.get('q', ""), int(before) if before.isdigit() else None
+
+
+def search_response(ids: list[int], pastes: list[tuple]) -> JsonResponse:
+    pastes = {paste[0]: paste for paste in pastes}
+    return JsonResponse({
+        'results': [
+            {
+                'url': reverse("myapp:view", args=(url_name,)),
+                'url_name': url_name,
+                'creation_date': creation_date,
+                'edited_date': edited_date,
+            }
+            for _, url_name, creation_date, edited_date in
+            (pastes[pk] for pk in ids[:SEARCH_PAGE_SIZE] if pk in pastes)
+        ],
+        # pass it as `before` to get the next page
+        'next': ids[SEARCH_PAGE_SIZE - 1] if len(ids) > SEARCH_PAGE_SIZE else None,
+    })
+
+
+# `retry_after_seconds` goes into `Retry-After`, for 429 and 503
+def error_page(request, error_code: int, retry_after_seconds: float | None = None) -> HttpResponse:
+    response = render(request, "myapp/error.html", {'error_code': error_code}, status=error_code)
+    if retry_after_seconds is not None:
+        response.headers['Retry-After'] = retry_after(retry_after_seconds)
+    return response
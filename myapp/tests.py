@@ -1,3 +1,910 @@
-from django.test import TestCase
+import asyncio
+import gzip
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.admin import site
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.management import call_command
+from django.db import connection
+from django.http import HttpResponse
+from django.test import AsyncRequestFactory, RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.html import escape
+
+from . import async_views, pages
+from .admin import PasteAdmin
+from .management.commands.import_pastes import Command as ImportPastes
+from .middleware import PRIMARY_COOKIE, replica_middleware
+from .models import Blob, Paste, hash_content
+from .modules import compilation
+from .modules.admission import ConcurrencyLimit, TokenBuckets
+from .modules.benchmarks import CORPORA, compare_results
+from .modules.compression import CODECS, compress, decompress, gzip_around
+from .modules.compilation import PLAIN_VERSION, CompileService, compile_plain
+from .modules.db import ReplicaRouter, apply_sqlite_pragmas
+from .modules.pagecache import ByteLRUCache
+from .modules.singleflight import AsyncSingleFlight
+from .modules.utils import hash_sha512
+from .modules.markdown import COMPILER_VERSION, compile_blocks, compile_md, compile_paste, create_compiler, split_paste
+
+
+# pastes as they come out of the `create`/`edit` forms: browsers send `\r\n`
+# and the contents are escaped before compiling them
+REAL_PASTES = [
+    "# opyn.\r\n\r\n## about\r\n\r\n[rentry](https://rentry.co/) rip-off.\r\n\r\n"
+    "## wtf is rentry\r\n\r\nit is like a pastebin, but only for markdown\r\n\r\n"
+    "just try it out and you will see",
+    "text can be **bold** btw, or *italic*, or ***both***\r\nand __underlined__ or ~~striked~~",
+    "-> right aligned ->\r\n\r\n-> centered <-\r\n\r\n<script>alert(1)</script>",
+    "some text\r\n---\r\nmore text\r\n***\r\nthe end",
+    "### todo\r\n\r\n* one\r\n* two\r\n* **three** * four\r\n\r\n###### tiny\r\n\r\n",
+    "unclosed **bold and *italic and __underline and ~~strike\r\n\r\n# # ## ### #\r\n\r\n",
+    "Traceback (most recent call last):\r\n  File \"manage.py\", line 22, in <module>\r\n"
+    "    main()\r\nKeyError: '__init__'\r\n\r\n__init__ __main__ **kwargs *args",
+    "-&gt; already escaped -&gt;\r\n\r\n&lt;- &amp;lt;- -&amp;gt;",
+    "",
+]
+
+# every symbol the grammar knows about split into pieces, so the fuzzer
+# hits overlapping and partial delimiters a lot more often than real text
+FUZZ_ALPHABET = [
+    "#", "# ", "## ", "*", "**", "***", "_", "__", "~", "~~", "-", "---", "->", "<-",
+    "-&gt;", "&lt;-", "&gt;", "&lt;", "\r", "\n", "\r\n", "\r\n\r\n", "\r\n---", "\r\n***", " ", "a", "text",
+]
+
+
+def _get_corpus() -> list[str]:
+    rng = random.Random(0)
+
+    corpus = []
+    for paste in REAL_PASTES:
+        corpus.append(paste)
+        corpus.append(escape(paste))
+        corpus.append(paste + '\r\n\r\n')
+    for _ in range(500):
+        corpus.append("".join(rng.choices(FUZZ_ALPHABET, k=rng.randint(1, 64))))
+
+    return corpus
+
+
+# the original character by character splitter, kept as the reference
+# note: it never flushes trailing text, `compile_md` always ends the input with a symbol
+def _reference_split(raw_md: str, unique_symbols: list[str]) -> list[str]:
+    raw_tokens: list[str] = []
+
+    buffer, skip = "", 0
+    for i in range(len(raw_md)):
+        if skip: skip -= 1; continue  # NOQA E702
+
+        match_found = False
+        for unique_symbol in unique_symbols:
+            if raw_md[i:i + len(unique_symbol)] == unique_symbol:
+                if buffer:
+                    raw_tokens.append(buffer)
+                    buffer = ""
+
+                raw_tokens.append(unique_symbol)
+                skip = len(unique_symbol) - 1
+                match_found = True
+                break
+        if not match_found:
+            buffer += raw_md[i]
+
+    return raw_tokens
+
+
+# the original grammar and matcher, kept as the reference for the compiler output
+REFERENCE_TOKENS = [
+    ('# ', '\r\n\r\n', '<h1 style=\"font-size: 3.5rem\">', '</h1><br>', True),
+    ('## ', '\r\n\r\n', '<h2 style=\"font-size: 2.25rem\">', '</h2><br>', True),
+    ('### ', '\r\n\r\n', '<h3 style=\"font-size: 1.75rem\">', '</h3><br>', True),
+    ('#### ', '\r\n\r\n', '<h4 style=\"font-size: 1.35rem\">', '</h4><br>', True),
+    ('##### ', '\r\n\r\n', '<h5 style=\"font-size: 1.25rem\">', '</h5><br>', True),
+    ('###### ', '\r\n\r\n', '<h6 style=\"font-size: 1.15rem\">', '</h6><br>', True),
+    ('*', '*', '<em>', '</em>', True),
+    ('**', '**', '<strong>', '</strong>', True),
+    ('__', '__', '<u>', '</u>', True),
+    ('~~', '~~', '<s>', '</s>', True),
+    ('***', '***', '<strong><em>', '</em></strong>', True),
+    ('-&gt;', '-&gt;', '<div style=\"text-align: right;\">', '</div>', True),
+    ('-&gt;', '&lt;-', '<div style=\"text-align: center;\">', '</div>', True),
+    ('\r\n---\r\n', None, '<hr>', None, False),
+    ('\r\n***\r\n', None, '<hr>', None, False),
+    ('\r\n\r\n', None, '<br>', None, False),
+    ('\r\n', None, ' ', None, False),
+]
+REFERENCE_SYMBOLS = sorted(
+    dict.fromkeys(symbol for token in REFERENCE_TOKENS for symbol in token[:2] if symbol is not None),
+    key=len, reverse=True
+)
+
+
+def _reference_compile_md(raw_md: str) -> str:
+    raw_tokens = _reference_split(raw_md + '\r\n\r\n', REFERENCE_SYMBOLS)
+
+    html, skip = "", 0
+    for i in range(len(raw_tokens)):
+        if skip: skip -= 1; continue  # NOQA E702
+
+        match_found = False
+        for opening, closing, compiled_opening, compiled_closing, enclosed in REFERENCE_TOKENS:
+            if i + 3 > len(raw_tokens):
+                break
+
+            if raw_tokens[i] == opening:
+                j = 0
+                if closing is not None:
+                    j, invalid = 1, False
+                    while raw_tokens[i+j] != closing:
+                        j += 1
+                        if i+j >= len(raw_tokens):
+                            invalid = True; break  # NOQA E702
+                    if invalid:
+                        continue
+
+                token_content = "".join(raw_tokens[i+1:i+j])
+                if any(symbol in token_content for symbol in REFERENCE_SYMBOLS):
+                    token_content = _reference_compile_md(token_content)
+
+                html += f"{compiled_opening}{token_content if enclosed else ''}{compiled_closing or ''}"
+                skip = j
+                match_found = True
+                break
+
+        if not match_found:
+            html += raw_tokens[i]
+
+    return html
+
+
+# a paste compiled by an older compiler
+def _create_stale_paste(content: str, paste_url: str) -> Paste:
+    blob = Blob.objects.create(hash=hash_content(content), content=content, compiled="stale html", references=1)
+    return Paste.objects.create(
+        blob=blob, url_name=paste_url, edit_code="code", creation_date=timezone.now(), edited_date=timezone.now()
+    )
+
+
+class MarkdownCompileTests(SimpleTestCase):
+    def test_compile_matches_reference(self):
+        for raw_md in _get_corpus():
+            with self.subTest(raw_md=raw_md):
+                self.assertEqual(compile_md(raw_md), _reference_compile_md(raw_md))
+
+    def test_deep_nesting(self):
+        # the reference gives up with a RecursionError long before this
+        self.assertTrue(compile_md('# ' * 5000 + 'deep').startswith('<h1 style="font-size: 3.5rem"><h1'))
+
+    def test_blocks_compile_like_whole_paste(self):
+        for content in _get_corpus():
+            blocks = split_paste(content)
+            with self.subTest(content=content):
+                self.assertEqual("".join(blocks), escape(content) + '\r\n\r\n')
+                self.assertEqual(
+                    "".join(compile_blocks([(block, k == len(blocks) - 1) for k, block in enumerate(blocks)])),
+                    compile_paste(content)
+                )
+
+        # nothing is split inside a token running over break lines
+        self.assertEqual(len(split_paste("**a\r\n\r\nb**\r\n\r\nc")), 2)
+
+    def test_max_depth(self):
+        self.assertEqual(compile_md('**a *b* c**', max_depth=0), '<strong>a *b* c</strong>\r\n\r\n')
+        self.assertEqual(compile_md('**a *b* c**', max_depth=1), '<strong>a <em>b</em> c\r\n\r\n</strong>\r\n\r\n')
+
+
+class MarkdownSplitTests(SimpleTestCase):
+    def test_split_matches_reference(self):
+        compiler = create_compiler()
+        unique_symbols = list(compiler.unique_symbols)
+
+        for raw_md in _get_corpus():
+            # `compile_md` always appends a break line before compiling
+            raw_md += '\r\n\r\n'
+            with self.subTest(raw_md=raw_md):
+                self.assertEqual(compiler.split(raw_md), _reference_split(raw_md, unique_symbols))
+
+    def test_split_keeps_longest_symbol(self):
+        compiler = create_compiler()
+
+        self.assertEqual(
+            compiler.split("a***b**c*\r\n***\r\n"),
+            ["a", "***", "b", "**", "c", "*", "\r\n***\r\n"]
+        )
+
+
+class CompressionTests(SimpleTestCase):
+    def test_codecs(self):
+        for codec in ('none', 'zlib', 'deflate'):
+            for s in ("", "short", "<h1 style=\"font-size: 3.5rem\">ünïcode</h1><br>" * 1000):
+                with self.subTest(codec=codec, s=s[:10]):
+                    value = compress(s, CODECS[codec])
+                    self.assertEqual(value[0], CODECS[codec])
+                    self.assertEqual(decompress(value), s)
+
+    def test_gzip_around(self):
+        for compiled in ("", "<em>compiled</em> " * 10000):
+            with self.subTest(compiled=compiled[:10]):
+                body = gzip_around(b"<html>" * 100, compress(compiled, CODECS['deflate']), "</html>ü".encode())
+                self.assertEqual(gzip.decompress(body).decode(), "<html>" * 100 + compiled + "</html>ü")
+
+        self.assertIsNone(gzip_around(b"", compress("zlib", CODECS['zlib']), b""))
+
+
+class BenchmarkTests(SimpleTestCase):
+    def test_corpora_sizes(self):
+        for name, generate in CORPORA.items():
+            with self.subTest(name=name):
+                self.assertEqual(len(generate(1000)), 1000)
+
+    def test_compare_results(self):
+        baseline = {'a': {'median': 1.0}, 'b': {'median': 2.0}, 'gone': {'median': 1.0}}
+        results = {'a': {'median': 1.2}, 'b': {'median': 3.0}, 'new': {'median': 1.0}}
+
+        ratios, regressions = compare_results(baseline, results, budget=1.25)
+        self.assertEqual(ratios, {'a': 1.2, 'b': 1.5})
+        self.assertEqual(regressions, ['b'])
+
+
+class AsyncSingleFlightTests(SimpleTestCase):
+    async def test_the_leader_going_away_does_not_cancel_the_others(self):
+        flight, calls = AsyncSingleFlight(), []
+
+        async def render():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "page"
+
+        leader = asyncio.create_task(flight.do("key", render))
+        await asyncio.sleep(0)
+        follower = asyncio.create_task(flight.do("key", render))
+        await asyncio.sleep(0)
+        leader.cancel()
+
+        self.assertEqual(await follower, "page")
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(len(calls), 1)
+
+
+class CompileServiceTests(SimpleTestCase):
+    def test_big_pastes_are_compiled_in_processes(self):
+        service = CompileService(inline_limit=8, processes=1, threads=1, timeout=30)
+        for content in ("small *one*", "a **big** one " * 100):
+            with self.subTest(content=content):
+                self.assertEqual(service.compile(content), (compile_paste(content), COMPILER_VERSION))
+
+    def test_slow_pastes_are_shown_as_plain_text(self):
+        service = CompileService(inline_limit=8, processes=1, threads=1, timeout=0.001)
+        content = "<slow> **paste** " * 10000
+
+        with self.assertLogs("myapp.modules.compilation", "WARNING"):
+            self.assertEqual(service.compile(content), (compile_plain(content), PLAIN_VERSION))
+        self.assertIn("&lt;slow&gt;", compile_plain(content))
+
+    def test_waiting_for_a_process_does_not_count(self):
+        service = CompileService(inline_limit=0, processes=1, threads=4, timeout=1)
+        service._get_pool().submit(int).result()  # started
+        # 4 in a row take longer than `timeout`, each by itself doesn't
+        with self.assertNoLogs("myapp.modules.compilation", "WARNING"):
+            jobs = [service.threads.submit(service._run, time.sleep, 0.3, 1, "") for _ in range(4)]
+            for job in jobs:
+                job.result()
+
+    def test_edits_only_compile_changed_blocks(self):
+        service = CompileService(
+            inline_limit=1 << 20, processes=1, threads=1, timeout=30, blocks=LocMemCache("test-blocks", {})
+        )
+        paragraphs = [f"# part {i}\r\n\r\nsome **bold** text and *more* of it " * 8 for i in range(50)]
+        content = "\r\n\r\n".join(paragraphs)
+        self.assertEqual(service.compile(content)[0], compile_paste(content))
+
+        paragraphs[20] = "an *edited* part"
+        edited = "\r\n\r\n".join(paragraphs)
+        with mock.patch.object(compilation, "compile_blocks", wraps=compile_blocks) as compiled:
+            self.assertEqual(service.compile(edited)[0], compile_paste(edited))
+
+        compiled_size = sum(len(block) for block, _ in compiled.call_args.args[0])
+        self.assertLess(compiled_size, len(edited) // 10)
+
+    def test_big_groups_are_not_cached(self):
+        blocks = LocMemCache("test-blocks", {})
+        service = CompileService(inline_limit=1 << 20, processes=1, threads=1, timeout=30, blocks=blocks)
+
+        huge = "one *long* line " * 20000  # a single block
+        self.assertEqual(service.compile(huge)[0], compile_paste(huge))
+        self.assertFalse(blocks._cache)
+
+        many = "\r\n\r\n".join(f"short *{i}*" for i in range(2000))
+        groups = compilation._split_groups(many)
+        self.assertLessEqual(max(len(group) for _, group, _ in groups), compilation._MAX_GROUP_SIZE)
+        self.assertEqual(service.compile(many)[0], compile_paste(many))
+        self.assertEqual(len(blocks._cache), len(groups))
+
+
+class ByteLRUCacheTests(SimpleTestCase):
+    def test_it_is_bounded_by_size(self):
+        cache = ByteLRUCache("test-bytes", {'OPTIONS': {'MAX_BYTES': 1000}})
+        cache.clear()
+        cache.set_many({f"key-{i}": "x" * 200 for i in range(10)})
+        self.assertEqual(cache.get_many([f"key-{i}" for i in range(10)]), {f"key-{i}": "x" * 200 for i in range(5, 10)})
+
+        cache.set("big", "x" * 300)  # more than a quarter of it
+        self.assertIsNone(cache.get("big"))
+        # the same one in every thread
+        self.assertEqual(ByteLRUCache("test-bytes", {}).get("key-9"), "x" * 200)
+
+
+class PasteViewTests(TestCase):
+    def setUp(self):
+        pages.page_cache.local.clear()
+
+    def create_paste(self, content: str, paste_url: str, edit_code: str = "code"):
+        return self.client.post(reverse("myapp:create"), {
+            'content': content,
+            'paste_url': paste_url,
+            'edit_code': edit_code
+        })
+
+    def test_create_and_view(self):
+        response = self.create_paste("# hello\r\n\r\nsome **bold** text", "hello")
+        self.assertRedirects(response, reverse("myapp:view", args=("hello",)))
+
+        response = self.client.get(reverse("myapp:view", args=("hello",)))
+        self.assertContains(response, '<h1 style="font-size: 3.5rem">hello</h1><br>')
+        self.assertContains(response, '<strong>bold</strong>')
+
+    def test_streamed_pages_match_rendered(self):
+        self.create_paste("-> streamed <-\r\n\r\n<b>not html</b> " * 50, "streamed")
+
+        for name in ("myapp:view", "myapp:raw"):
+            with self.subTest(name=name):
+                rendered = self.client.get(reverse(name, args=("streamed",)))
+                with override_settings(STREAM_PASTES=True, STREAM_CHUNK_SIZE=7):
+                    streamed = self.client.get(reverse(name, args=("streamed",)))
+
+                self.assertTrue(streamed.streaming)
+                self.assertEqual(b"".join(streamed.streaming_content), rendered.content)
+
+    def test_paste_urls_are_not_taken_for_the_streamed_body(self):
+        self.create_paste("the *paste*", "opyn-streamed-body")
+
+        for name in ("myapp:view", "myapp:raw"):
+            with self.subTest(name=name):
+                rendered = self.client.get(reverse(name, args=("opyn-streamed-body",)))
+                with override_settings(STREAM_PASTES=True):
+                    streamed = self.client.get(reverse(name, args=("opyn-streamed-body",)))
+                self.assertEqual(b"".join(streamed.streaming_content), rendered.content)
+
+                if name == "myapp:view":
+                    gzipped = self.client.get(reverse(name, args=("opyn-streamed-body",)), HTTP_ACCEPT_ENCODING="gzip")
+                    self.assertEqual(gzip.decompress(gzipped.content), rendered.content)
+
+    def test_stale_paste_is_recompiled_on_view(self):
+        paste = _create_stale_paste("**fresh** <i>", "stale")
+
+        response = self.client.get(reverse("myapp:view", args=("stale",)))
+        self.assertContains(response, "<strong>fresh</strong> &lt;i&gt;")
+        self.assertNotContains(response, "stale html")
+
+        blob = Blob.objects.get(pk=paste.blob_id)
+        self.assertEqual(blob.compiler_version, COMPILER_VERSION)
+        self.assertEqual(blob.compiled, compile_paste(blob.content))
+
+    def test_conditional_get(self):
+        self.create_paste("cache **me**", "cached")
+
+        for name in ("myapp:view", "myapp:raw", "myapp:raw_plain"):
+            with self.subTest(name=name):
+                response = self.client.get(reverse(name, args=("cached",)))
+                self.assertEqual(response.status_code, 200)
+                self.assertIn("public", response.headers['Cache-Control'])
+
+                # without the page cached only the validators are looked up
+                pages.page_cache.local.clear()
+                with self.assertNumQueries(1):
+                    not_modified = self.client.get(
+                        reverse(name, args=("cached",)), HTTP_IF_NONE_MATCH=response.headers['ETag']
+                    )
+                self.assertEqual(not_modified.status_code, 304)
+                self.assertEqual(not_modified.headers['ETag'], response.headers['ETag'])
+
+                not_modified = self.client.get(
+                    reverse(name, args=("cached",)), HTTP_IF_MODIFIED_SINCE=response.headers['Last-Modified']
+                )
+                self.assertEqual(not_modified.status_code, 304)
+
+        view_etag = self.client.get(reverse("myapp:view", args=("cached",))).headers['ETag']
+        self.client.post(reverse("myapp:edit", args=("cached",)), {
+            'new_content': "cache **me** again", 'new_paste_url': "", 'edit_code': "code", 'new_edit_code': ""
+        })
+        response = self.client.get(reverse("myapp:view", args=("cached",)), HTTP_IF_NONE_MATCH=view_etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], view_etag)
+
+    def test_page_cache(self):
+        self.create_paste("hot *paste*", "hot")
+        first = self.client.get(reverse("myapp:view", args=("hot",)))
+
+        with self.assertNumQueries(1):  # only the version is looked up
+            cached = self.client.get(reverse("myapp:view", args=("hot",)))
+        self.assertEqual(cached.content, first.content)
+
+        self.client.post(reverse("myapp:edit", args=("hot",)), {
+            'new_content': "cold *paste*", 'new_paste_url': "cold", 'edit_code': "code", 'new_edit_code': ""
+        })
+        self.assertContains(self.client.get(reverse("myapp:view", args=("cold",))), "cold <em>paste</em>")
+        self.assertNotIn(b"<em>paste</em>", self.client.get(reverse("myapp:view", args=("hot",))).content)
+
+    def test_cached_pages_see_changes_from_other_processes(self):
+        self.create_paste("hot *paste*", "hot")
+        for name in ("myapp:view", "myapp:raw"):
+            self.client.get(reverse(name, args=("hot",)))
+
+        # as if another process made them, nothing invalidates the pages here
+        other = Paste.objects.get(url_name="hot")
+        other.save_content("cold *paste*")
+        self.assertContains(self.client.get(reverse("myapp:view", args=("hot",))), "cold <em>paste</em>")
+        self.assertContains(self.client.get(reverse("myapp:raw", args=("hot",))), "cold *paste*")
+
+        Paste.objects.filter(url_name="hot").delete()
+        for name in ("myapp:view", "myapp:raw"):
+            with self.subTest(name=name):
+                self.assertEqual(self.client.get(reverse(name, args=("hot",))).status_code, 404)
+
+    def test_pastes_are_stored_compressed(self):
+        content = "# big\r\n\r\n" + "some **bold** text " * 1000 + "end"
+        self.create_paste(content, "big")
+
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT content, compiled FROM myapp_blob WHERE hash = %s", [hash_content(content)])
+            stored_content, stored_compiled = map(bytes, cursor.fetchone())
+        self.assertLess(len(stored_content), len(content) // 10)
+        self.assertEqual(decompress(stored_compiled), compile_paste(content))
+        self.assertEqual(Paste.objects.get(url_name="big").blob.content, content)
+
+    def test_plain_text_fallbacks_are_only_compiled_again_by_recompile_pastes(self):
+        with mock.patch.object(compilation.compile_service, "_compile", return_value=None):
+            self.create_paste("a **slow** one", "slow")
+        blob = Blob.objects.get()
+        self.assertEqual(blob.compiler_version, PLAIN_VERSION)
+
+        with mock.patch.object(compilation.compile_service, "compile") as compiled:
+            for _ in range(2):
+                response = self.client.get(reverse("myapp:view", args=("slow",)))
+                self.assertContains(response, "a **slow** one")
+            not_modified = self.client.get(reverse("myapp:view", args=("slow",)), HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(compiled.call_count, 0)
+        self.assertEqual(not_modified.status_code, 304)
+
+        call_command("recompile_pastes", only_stale=True, workers=1, stdout=StringIO())
+        blob.refresh_from_db()
+        self.assertEqual(blob.compiler_version, COMPILER_VERSION)
+        self.assertContains(self.client.get(reverse("myapp:view", args=("slow",))), "a <strong>slow</strong> one")
+
+    def test_duplicate_pastes_share_a_blob(self):
+        with mock.patch.object(compilation.compile_service, "compile", wraps=compilation.compile_service.compile) as compiled:
+            self.create_paste("the same **log**", "first")
+            self.create_paste("the same **log**", "second")
+        self.assertEqual(compiled.call_count, 1)
+
+        blob = Blob.objects.get()
+        self.assertEqual(blob.references, 2)
+        self.assertContains(self.client.get(reverse("myapp:view", args=("second",))), "the same <strong>log</strong>")
+
+        self.client.post(reverse("myapp:edit", args=("first",)), {
+            'new_content': "something else", 'new_paste_url': "", 'edit_code': "code", 'new_edit_code': ""
+        })
+        blob.refresh_from_db()
+        self.assertEqual(blob.references, 1)
+
+        Paste.objects.get(url_name="second").delete()
+        self.assertFalse(Blob.objects.filter(pk=blob.pk).exists())
+        self.assertEqual(Blob.objects.get().references, 1)
+
+    def test_gzip_view(self):
+        self.create_paste("gzipped *paste*", "gz")
+        plain = self.client.get(reverse("myapp:view", args=("gz",)))
+
+        response = self.client.get(reverse("myapp:view", args=("gz",)), HTTP_ACCEPT_ENCODING="gzip, deflate")
+        self.assertEqual(response.headers['Content-Encoding'], "gzip")
+        self.assertEqual(response.headers['ETag'], f"W/{plain.headers['ETag']}")
+        self.assertIn("Accept-Encoding", response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.content), plain.content)
+
+        # revalidating it gets the same validators back, with the page cached and without
+        for cached in (True, False):
+            if not cached:
+                pages.page_cache.local.clear()
+            not_modified = self.client.get(
+                reverse("myapp:view", args=("gz",)), HTTP_ACCEPT_ENCODING="gzip", HTTP_IF_NONE_MATCH=response['ETag']
+            )
+            self.assertEqual(not_modified.status_code, 304)
+            self.assertEqual(not_modified.headers['ETag'], response.headers['ETag'])
+            self.assertIn("Accept-Encoding", not_modified.headers['Vary'])
+
+        self.client.post(reverse("myapp:edit", args=("gz",)), {
+            'new_content': "edited *paste*", 'new_paste_url': "", 'edit_code': "code", 'new_edit_code': ""
+        })
+        response = self.client.get(reverse("myapp:view", args=("gz",)), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertIn(b"edited <em>paste</em>", gzip.decompress(response.content))
+
+        with override_settings(SERVE_GZIP_PASTES=False):
+            response = self.client.get(reverse("myapp:view", args=("gz",)), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_raw_plain(self):
+        self.create_paste("<b>plain</b> **text**", "plain")
+
+        response = self.client.get(reverse("myapp:raw_plain", args=("plain",)))
+        self.assertEqual(response.headers['Content-Type'], "text/plain; charset=utf-8")
+        self.assertEqual(response.content, b"<b>plain</b> **text**")
+
+    def test_server_timing(self):
+        response = self.create_paste("some **timed** text", "timed")
+        phases = [timing.split(";")[0] for timing in response.headers['Server-Timing'].split(", ")]
+        for phase in ("db", "hash_sha512", "compile_md", "total"):
+            self.assertIn(phase, phases)
+
+        response = self.client.get(reverse("myapp:view", args=("timed",)))
+        self.assertIn("render;dur=", response.headers['Server-Timing'])
+
+        metrics = self.client.get(reverse("myapp:metrics")).content.decode()
+        self.assertIn('opyn_request_duration_seconds_bucket{url_name="myapp:view",le="+Inf"}', metrics)
+        self.assertIn('opyn_request_phase_duration_seconds_count{url_name="myapp:create",phase="compile_md"}', metrics)
+
+    def test_pages_only_load_needed_columns(self):
+        self.create_paste("some **columns**", "columns")
+
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse("myapp:view", args=("columns",)))
+            self.client.get(reverse("myapp:raw", args=("columns",)))
+            self.client.get(reverse("myapp:edit", args=("columns",)))
+        self.assertNotIn('"content"', queries[0]['sql'])
+        self.assertNotIn('"compiled"', queries[1]['sql'])
+        self.assertNotIn('"compiled"', queries[2]['sql'])
+
+
+class AsyncViewTests(TestCase):
+    def setUp(self):
+        pages.page_cache.local.clear()
+        self.factory = AsyncRequestFactory()
+
+    async def test_create_view_and_edit(self):
+        response = await async_views.create(self.factory.post(reverse("myapp:create"), {
+            'content': "async **paste**", 'paste_url': "async", 'edit_code': "code"
+        }))
+        self.assertEqual(response.status_code, 302)
+
+        response = await async_views.view(self.factory.get(reverse("myapp:view", args=("async",))), "async")
+        self.assertContains(response, "async <strong>paste</strong>")
+
+        response = await async_views.view(self.factory.get(
+            reverse("myapp:view", args=("async",)), headers={'If-None-Match': response.headers['ETag']}
+        ), "async")
+        self.assertEqual(response.status_code, 304)
+
+        response = await async_views.edit(self.factory.post(reverse("myapp:edit", args=("async",)), {
+            'new_content': "async *edit*", 'new_paste_url': "", 'edit_code': "code", 'new_edit_code': ""
+        }), "async")
+        self.assertEqual(response.status_code, 302)
+
+        response = await async_views.raw_plain(self.factory.get(reverse("myapp:raw_plain", args=("async",))), "async")
+        self.assertEqual(response.content, b"async *edit*")
+        response = await async_views.view(self.factory.get(reverse("myapp:view", args=("async",))), "async")
+        self.assertContains(response, "async <em>edit</em>")
+
+    async def test_posts_wait_for_a_free_slot(self):
+        slots = ConcurrencyLimit(1, 0.05)
+        with mock.patch.object(pages, "post_slots", slots):
+            self.assertTrue(slots.acquire())  # someone else is compiling
+            response = await async_views.create(self.factory.post(reverse("myapp:create"), {
+                'content': "busy", 'paste_url': "busy", 'edit_code': "code"
+            }))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], "1")
+
+            asyncio.get_running_loop().call_later(0.01, slots.release)
+            slots.timeout = 5
+            response = await async_views.create(self.factory.post(reverse("myapp:create"), {
+                'content': "busy", 'paste_url': "busy", 'edit_code': "code"
+            }))
+            self.assertEqual(response.status_code, 302)
+
+    async def test_stale_paste_is_recompiled(self):
+        paste = await sync_to_async(_create_stale_paste)("**fresh**", "async-stale")
+
+        response = await async_views.view(
+            self.factory.get(reverse("myapp:view", args=("async-stale",))), "async-stale"
+        )
+        self.assertContains(response, "<strong>fresh</strong>")
+        self.assertEqual((await Blob.objects.aget(pk=paste.blob_id)).compiler_version, COMPILER_VERSION)
+
+
+class RecompilePastesTests(TestCase):
+    def test_recompiles_stale_pastes(self):
+        fresh = _create_stale_paste("paste **3**", "paste-3").blob_id
+        Blob.objects.filter(pk=fresh).update(compiler_version=COMPILER_VERSION)
+        for i in (0, 1, 2, 4):
+            _create_stale_paste(f"paste **{i}**", f"paste-{i}")
+
+        first = Blob.objects.order_by("pk").first()
+        output = StringIO()
+        call_command("recompile_pastes", workers=2, batch_size=2, only_stale=True, start_after=first.pk, stdout=output)
+
+        self.assertIn(f"recompiled {3 if first.pk != fresh else 4} pastes", output.getvalue())
+        for blob in Blob.objects.order_by("pk"):
+            if blob.pk == first.pk or blob.pk == fresh:
+                self.assertEqual(blob.compiled, "stale html")
+            else:
+                self.assertEqual(blob.compiled, compile_paste(blob.content))
+                self.assertEqual(blob.compiler_version, COMPILER_VERSION)
+
+
+@override_settings(PASTE_SEARCH_ENDPOINT=True)
+class SearchTests(TestCase):
+    def search(self, query: str, **params) -> dict:
+        response = self.client.get(reverse("myapp:search"), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_search_follows_edits_and_deletes(self):
+        for i in range(25):
+            self.client.post(reverse("myapp:create"), {
+                'content': f"paste number {i}\r\n\r\nsome **Café** logs", 'paste_url': f"paste-{i}", 'edit_code': "code"
+            })
+
+        page = self.search("cafe LOGS")
+        self.assertEqual(len(page['results']), pages.SEARCH_PAGE_SIZE)
+        self.assertEqual(page['results'][0]['url'], reverse("myapp:view", args=("paste-24",)))
+        page = self.search("cafe logs", before=page['next'])
+        self.assertEqual([result['url_name'] for result in page['results']], [f"paste-{i}" for i in range(4, -1, -1)])
+        self.assertIsNone(page['next'])
+
+        self.client.post(reverse("myapp:edit", args=("paste-3",)), {
+            'new_content': "nothing to see", 'new_paste_url': "renamed", 'edit_code': "code", 'new_edit_code': ""
+        })
+        Paste.objects.get(url_name="paste-2").delete()
+        self.assertEqual([result['url_name'] for result in self.search("number 3")['results']], [])
+        self.assertEqual([result['url_name'] for result in self.search("see")['results']], ["renamed"])
+        self.assertEqual(len(self.search('" cafe OR')['results']), 0)
+
+        # the index keeps no copy of the pastes, and is filled again from them
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT DISTINCT content FROM myapp_paste_search")
+            self.assertEqual(cursor.fetchall(), [(None,)])
+        for rebuild in (True, False):
+            call_command("index_pastes", batch_size=7, rebuild=rebuild, stdout=StringIO())
+            page = self.search("number")
+            self.assertEqual(len(page['results']), 20)
+            self.assertEqual(len(self.search("number", before=page['next'])['results']), 3)
+
+    def test_admin_search_without_words(self):
+        self.client.post(reverse("myapp:create"), {'content': "some words", 'paste_url': "words", 'edit_code': "code"})
+        paste_admin = PasteAdmin(Paste, site)
+        for term in ("   ", "words"):
+            with self.subTest(term=term):
+                pastes, _ = paste_admin.get_search_results(None, Paste.objects.all(), term)
+                self.assertEqual([paste.url_name for paste in pastes], [] if term.isspace() else ["words"])
+
+    def test_search_is_off_by_default(self):
+        with override_settings(PASTE_SEARCH_ENDPOINT=False):
+            self.assertTemplateUsed(self.client.get(reverse("myapp:search"), {'q': "x"}), "myapp/error.html")
+
+
+class AdmissionTests(TestCase):
+    def create_paste(self, paste_url: str):
+        return self.client.post(reverse("myapp:create"), {'content': "text", 'paste_url': paste_url, 'edit_code': "code"})
+
+    def test_clients_posting_too_much_are_told_to_wait(self):
+        with mock.patch.object(pages, "post_buckets", TokenBuckets(0.1, 2)):
+            self.assertEqual(self.create_paste("one").status_code, 302)
+            self.assertEqual(self.create_paste("two").status_code, 302)
+
+            response = self.create_paste("three")
+            self.assertEqual(response.status_code, 429)
+            self.assertTemplateUsed(response, "myapp/error.html")
+            self.assertIn(int(response.headers['Retry-After']), (9, 10))
+            self.assertFalse(Paste.objects.filter(url_name="three").exists())
+
+            # someone else and pages aren't limited
+            self.assertEqual(self.create_paste("three").status_code, 429)
+            self.assertEqual(
+                self.client.post(reverse("myapp:create"), {
+                    'content': "text", 'paste_url': "three", 'edit_code': "code"
+                }, REMOTE_ADDR="10.0.0.2").status_code, 302
+            )
+            self.assertEqual(self.client.get(reverse("myapp:view", args=("one",))).status_code, 200)
+
+    def test_posts_without_a_free_slot_are_told_to_wait(self):
+        slots = ConcurrencyLimit(1, 5)
+        with mock.patch.object(pages, "post_slots", slots):
+            self.assertTrue(slots.acquire())  # someone else is compiling
+            started = time.monotonic()
+            response = self.create_paste("busy")
+            self.assertLess(time.monotonic() - started, 1)  # right away
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], "5")
+            self.assertEqual(self.client.get(reverse("myapp:create")).status_code, 200)
+
+            slots.release()
+            self.assertEqual(self.create_paste("busy").status_code, 302)
+            self.assertTrue(slots.acquire())  # and it gave the slot back
+
+    def test_error_pages_have_their_status(self):
+        self.assertEqual(self.client.get(reverse("myapp:view", args=("nothing",))).status_code, 404)
+
+
+class ExpiryTests(TestCase):
+    def setUp(self):
+        pages.page_cache.local.clear()
+
+    def create_paste(self, paste_url: str, expires_in: str, content: str = "short **lived**"):
+        return self.client.post(reverse("myapp:create"), {
+            'content': content, 'paste_url': paste_url, 'edit_code': "code", 'expires_in': expires_in
+        })
+
+    def test_expired_pastes_are_gone(self):
+        self.assertEqual(self.create_paste("never", "").status_code, 302)
+        self.assertEqual(self.create_paste("soon", "10m").status_code, 302)
+        self.assertIsNone(Paste.objects.get(url_name="never").expires_at)
+        self.assertAlmostEqual(
+            Paste.objects.get(url_name="soon").expires_at.timestamp(), time.time() + 600, delta=60
+        )
+        self.assertContains(self.create_paste("bad", "forever"), "unknown expiry")
+
+        url = reverse("myapp:view", args=("soon",))
+        view = self.client.get(url)
+        self.assertEqual(view.status_code, 200)
+        self.assertEqual(self.client.get(url, HTTP_ACCEPT_ENCODING="gzip").status_code, 200)
+
+        # cached pages know when the paste expires
+        with mock.patch("time.time", return_value=time.time() + 601):
+            for name in ("view", "raw"):
+                self.assertEqual(self.client.get(reverse(f"myapp:{name}", args=("soon",))).status_code, 404)
+            self.assertEqual(self.client.get(url, HTTP_ACCEPT_ENCODING="gzip").status_code, 404)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=view.headers['ETag']).status_code, 404)
+
+        Paste.objects.filter(url_name="soon").update(expires_at=timezone.now() - timedelta(seconds=1))
+        pages.page_cache.local.clear()
+        for name in ("view", "raw", "raw_plain", "edit"):
+            self.assertEqual(self.client.get(reverse(f"myapp:{name}", args=("soon",))).status_code, 404)
+        self.assertEqual(self.client.get(reverse("myapp:view", args=("never",))).status_code, 200)
+
+    def test_purge_expired(self):
+        for i in range(5):
+            self.create_paste(f"paste-{i}", "1h" if i % 2 else "10m", "the same paste")
+        self.create_paste("other", "1h", "another paste")
+        Paste.objects.exclude(url_name="paste-1").update(expires_at=timezone.now() - timedelta(seconds=1))
+
+        output, errors = StringIO(), StringIO()
+        call_command("purge_expired", batch_size=2, vacuum=True, stdout=output, stderr=errors)
+        self.assertIn("deleted 5 expired pastes", output.getvalue())
+        self.assertIn("incremental vacuum is off", errors.getvalue())
+
+        self.assertEqual(list(Paste.objects.values_list("url_name", flat=True)), ["paste-1"])
+        self.assertEqual(list(Blob.objects.values_list("content", "references")), [("the same paste", 1)])
+        with connection.cursor() as cursor:
+            self.assertEqual(cursor.execute("SELECT count(*) FROM myapp_paste_search").fetchone()[0], 1)
+
+
+class ImportExportTests(TestCase):
+    def test_pastes_survive_export_and_import(self):
+        for i in range(5):
+            self.client.post(reverse("myapp:create"), {
+                'content': f"paste **{i % 2}**", 'paste_url': f"paste-{i}", 'edit_code': f"code {i}"
+            })
+        exported = StringIO()
+        call_command("export_pastes", stdout=exported, stderr=StringIO(), batch_size=2)
+        before = {paste.url_name: (paste.edit_code, paste.creation_date) for paste in Paste.objects.all()}
+
+        Paste.objects.all().delete()
+        self.assertFalse(Blob.objects.exists())
+
+        lines = exported.getvalue().splitlines()
+        lines += [
+            lines[0],  # taken by then
+            '{"url_name": "new", "content": "  new **paste**  ", "edit_code": "new code"}',
+            '{"url_name": "bad url", "content": "x", "edit_code": "x"}',
+            "not json",
+            '{"url_name": "number", "content": 5, "edit_code": "x"}',
+            '{"url_name": null, "content": "x", "edit_code": "x", "creation_date": "2024-13-01T00:00:00"}',
+            '["a list"]',
+        ]
+        errors = StringIO()
+        with mock.patch("sys.stdin", StringIO("\n".join(lines) + "\n")):
+            call_command("import_pastes", workers=2, batch_size=3, stdout=StringIO(), stderr=errors)
+
+        self.assertEqual(errors.getvalue().count("\n"), 6)
+        self.assertIn("line 6: paste-0: such url is already taken", errors.getvalue())
+        self.assertIn("line 10: not a paste (TypeError('content is not a string'))", errors.getvalue())
+        self.assertIn("line 11: not a paste (ValueError(", errors.getvalue())
+        self.assertEqual(
+            {paste.url_name: (paste.edit_code, paste.creation_date) for paste in Paste.objects.exclude(url_name="new")},
+            before
+        )
+        self.assertEqual(Paste.objects.get(url_name="new").edit_code, hash_sha512("new code"))
+        self.assertEqual(
+            dict(Blob.objects.values_list("content", "references")), {"paste **0**": 3, "paste **1**": 2, "new **paste**": 1}
+        )
+        for blob in Blob.objects.all():
+            self.assertEqual(blob.compiled, compile_paste(blob.content))
+
+        response = self.client.get(reverse("myapp:view", args=("paste-3",)))
+        self.assertContains(response, "<strong>1</strong>")
+
+
+    def test_urls_taken_while_importing_are_reported(self):
+        self.client.post(reverse("myapp:create"), {'content': "first", 'paste_url': "taken", 'edit_code': "code"})
+        pastes = [
+            (line_number, Paste(
+                blob_id=hash_content(content), url_name=paste_url, edit_code=hash_sha512("code"),
+                creation_date=timezone.now(), edited_date=timezone.now()
+            ))
+            for line_number, paste_url, content in ((3, "taken", "second"), (4, "free", "third"))
+        ]
+        contents = {hash_content(content): content for content in ("second", "third")}
+
+        with ThreadPoolExecutor(1) as executor:
+            saved, dropped = ImportPastes.save_batch(executor, pastes, contents, 1)
+        self.assertEqual((saved, dropped), (1, [(3, "taken")]))
+        self.assertEqual(Paste.objects.get(url_name="taken").blob.content, "first")
+        self.assertFalse(Blob.objects.filter(pk=hash_content("second")).exists())
+
+
+class SqlitePragmaTests(TestCase):
+    @override_settings(SQLITE_PRAGMAS={'cache_size': -1234, 'busy_timeout': 1234})
+    def test_pragmas_are_applied(self):
+        apply_sqlite_pragmas(None, connection)
+
+        with connection.cursor() as cursor:
+            self.assertEqual(cursor.execute("PRAGMA cache_size").fetchone()[0], -1234)
+            self.assertEqual(cursor.execute("PRAGMA busy_timeout").fetchone()[0], 1234)
+
+
+@override_settings(DB_REPLICAS=["replica_0.sqlite3", "replica_1.sqlite3"])
+class ReplicaRouterTests(SimpleTestCase):
+    router = ReplicaRouter(["replica_0", "replica_1"])
+
+    def request(self, request, write: bool = False) -> tuple[HttpResponse, set[str]]:
+        reads = set()
+
+        def get_response(request):
+            reads.update(self.router.db_for_read(Paste) for _ in range(20))
+            if write:
+                self.assertEqual(self.router.db_for_write(Paste), "default")
+                reads.add(self.router.db_for_read(Paste))
+            return HttpResponse()
+
+        return replica_middleware(get_response)(request), reads
+
+    def test_reads_are_spread_over_replicas(self):
+        response, reads = self.request(RequestFactory().get("/paste"))
+        self.assertEqual(reads, {"replica_0", "replica_1"})
+        self.assertNotIn(PRIMARY_COOKIE, response.cookies)
+
+    def test_outside_of_requests_only_the_primary_is_used(self):
+        self.assertEqual(self.router.db_for_read(Paste), "default")
+
+    def test_writers_read_their_writes(self):
+        # `create` checks if the url is taken on the primary
+        response, reads = self.request(RequestFactory().post("/create/"), write=True)
+        self.assertEqual(reads, {"default"})
+        self.assertIn(PRIMARY_COOKIE, response.cookies)
+
+        # a read after a write in the same request
+        response, reads = self.request(RequestFactory().get("/paste"), write=True)
+        self.assertEqual(reads - {"replica_0", "replica_1"}, {"default"})
+
+        # and the redirect after it
+        request = RequestFactory().get("/paste")
+        request.COOKIES[PRIMARY_COOKIE] = "1"
+        response, reads = self.request(request)
+        self.assertEqual(reads, {"default"})
@@ -1,15 +1,22 @@
+from django.conf import settings
 from django.urls import path
 
-from . import views
+from . import async_views, views as sync_views
+
+# async views are only worth it under ASGI
+views = async_views if settings.ASYNC_VIEWS else sync_views
 
 app_name = "myapp"
 urlpatterns = [
     path("", views.index, name="index"),
     path("create/", views.create, name="create"),
+    path("search/", views.search_pastes, name="search"),
     path("<slug:paste_url>", views.view, name="view"),
     path("<slug:paste_url>/edit", views.edit, name="edit"),
     path("<slug:paste_url>/raw", views.raw, name="raw"),
+    path("<slug:paste_url>/raw.txt", views.raw_plain, name="raw_plain"),
     path("status/404/", views.page_not_found, name="page_not_found"),
     path("status/500/", views.server_error, name="server_error"),
-    path("status/400/", views.page_not_found, name="bad_request")
+    path("status/400/", views.page_not_found, name="bad_request"),
+    path("status/metrics", views.metrics, name="metrics")
 ]
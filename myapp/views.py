@@ -1,129 +1,193 @@
-import hashlib
-from datetime import datetime
-import random
-import string
-
-from django.core.exceptions import ValidationError
-from django.core.validators import validate_slug
-from django.db import IntegrityError
-from django.http import HttpResponseRedirect
+from functools import wraps
+
+from django.conf import settings
+from django.db import router
+from django.http import Http404, HttpResponse, HttpResponseRedirect, StreamingHttpResponse
 from django.shortcuts import render, get_object_or_404
+from django.template.loader import render_to_string
 from django.urls import reverse
-from django.utils.html import escape
+from django.utils.cache import patch_vary_headers
 
 from .models import Paste
-from .modules.markdown import compile_md
-from .modules.utils import hash_sha512
+from .modules import search
+from .modules.pagecache import CachedPage
+from .modules.timing import request_metrics
+from .pages import (
+    RAW_FIELDS, SEARCH_PAGE_SIZE, VIEW_FIELDS, NotDeflated, admitted, apply_edit, cache_page,
+    check_expiry, error_page, get_edited_pages, get_gzip_view_query, get_not_modified, get_page_validators,
+    get_search_params, get_stored_validators, get_validators, gzip_response, in_chunks, new_paste, page_cache,
+    prepare_create, prepare_edit, render_around, render_gzip_view, search_response, set_validators, validate_create,
+    validate_edit, wants_gzip
+)
+
+
+# renders everything around the paste first and sends it out right away,
+# then the paste itself follows in chunks
+def _stream_render(request, template_name: str, context: dict, body_name: str, body) -> StreamingHttpResponse:
+    head, tail = render_around(request, template_name, context, body_name)
+
+    def stream():
+        yield head
+        yield from body
+        yield tail
+
+    return StreamingHttpResponse(stream())
+
+
+# answers conditional requests for a paste page with a 304 by only
+# looking up the validators (in the cache or the db) and not the paste itself
+def _conditional_paste(kind: str):
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, paste_url: str):
+            if 'If-None-Match' in request.headers or 'If-Modified-Since' in request.headers:
+                page = page_cache.get((kind, paste_url))
+                if page is not None:
+                    validators = check_expiry(page).etag, page.last_modified
+                else:
+                    validators = get_page_validators(paste_url).first()
+                    if validators is not None:
+                        validators = get_stored_validators(kind, *validators)
+
+                if validators is not None:
+                    response = get_not_modified(request, kind, *validators)
+                    if response is not None:
+                        return response
+
+            return view_func(request, paste_url)
+        return wrapper
+    return decorator
 
 
 def index(request):
     return render(request, "myapp/index.html")
 
 
+@_conditional_paste("view")
 def view(request, paste_url: str):
-    paste = get_object_or_404(Paste, url_name=paste_url)
-    return render(request, "myapp/view.html", {
-        'compiled': paste.compiled,
-        'current_url': paste_url
-    })
+    if wants_gzip(request):
+        try:
+            return gzip_response(check_expiry(page_cache.get_or_render(
+                ("view.gz", paste_url),
+                lambda: render_gzip_view(request, paste_url, get_gzip_view_query(paste_url).first())
+            )))
+        except NotDeflated:
+            pass
+
+    if settings.STREAM_PASTES:  # streamed pages are too big to be worth caching
+        paste = get_object_or_404(
+            Paste.objects.unexpired().select_related('blob').only(*VIEW_FIELDS), url_name=paste_url
+        )
+        paste.blob.refresh_compiled()
+        response = _stream_render(request, "myapp/view.html", {
+            'current_url': paste_url
+        }, 'compiled', in_chunks(paste.blob.compiled))
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return set_validators(response, *get_validators(paste.blob_id, paste.edited_date, paste.blob.compiler_version))
+
+    def render_page() -> CachedPage:
+        paste = get_object_or_404(
+            Paste.objects.unexpired().select_related('blob').only(*VIEW_FIELDS), url_name=paste_url
+        )
+        paste.blob.refresh_compiled()
+        return cache_page(paste, paste.blob.compiler_version, render_to_string("myapp/view.html", {
+            'compiled': paste.blob.compiled,
+            'current_url': paste_url
+        }, request))
+
+    page = check_expiry(page_cache.get_or_render(("view", paste_url), render_page))
+    response = set_validators(HttpResponse(page.body), page.etag, page.last_modified)
+    patch_vary_headers(response, ('Accept-Encoding',))
+    return response
 
 
+@_conditional_paste("raw")
 def raw(request, paste_url: str):
-    paste = get_object_or_404(Paste, url_name=paste_url)
-    return render(request, "myapp/raw.html", {
-        'raw_markdown': paste.content,
-        'current_url': paste_url
-    })
+    if settings.STREAM_PASTES:
+        paste = get_object_or_404(
+            Paste.objects.unexpired().select_related('blob').only(*RAW_FIELDS), url_name=paste_url
+        )
+        response = _stream_render(request, "myapp/raw.html", {
+            'current_url': paste_url
+        }, 'raw_markdown', in_chunks(paste.blob.content, escaped=True))
+        return set_validators(response, *get_validators(paste.blob_id, paste.edited_date, None))
+
+    def render_page() -> CachedPage:
+        paste = get_object_or_404(
+            Paste.objects.unexpired().select_related('blob').only(*RAW_FIELDS), url_name=paste_url
+        )
+        return cache_page(paste, None, render_to_string("myapp/raw.html", {
+            'raw_markdown': paste.blob.content,
+            'current_url': paste_url
+        }, request))
+
+    page = check_expiry(page_cache.get_or_render(("raw", paste_url), render_page))
+    return set_validators(HttpResponse(page.body), page.etag, page.last_modified)
+
 
+@_conditional_paste("plain")
+def raw_plain(request, paste_url: str):
+    paste = Paste.objects.unexpired().filter(url_name=paste_url) \
+        .values_list('blob__content', 'blob', 'edited_date').first()
+    if paste is None:
+        raise Http404
 
+    content, content_hash, edited_date = paste
+    response = HttpResponse(content, content_type="text/plain; charset=utf-8")
+    return set_validators(response, *get_validators(content_hash, edited_date, None))
+
+
+@admitted
 def create(request):
     if not request.POST:  # if it is just viewing the page
         return render(request, "myapp/create.html")
     else:
         # prepare
-        content = request.POST['content'].strip()
-        paste_url = request.POST['paste_url'].strip()
-        if not paste_url:
-            paste_url = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
+        content, paste_url = prepare_create(request.POST)
 
         # validate
-        error_messages = []
-        if len(content) > 262144:
-            error_messages.append(f"contents is too long ({len(content)} > 262144)")
-        elif len(content) < 1:
-            error_messages.append(f"contents are too short ({len(content)} < 1)")
-        if len(paste_url) > 256:
-            error_messages.append(f"paste url is too long ({len(paste_url)} > 256)")
-        if len(request.POST['edit_code']) > 512:
-            error_messages.append(f"edit code is too long ({len(request.POST['edit_code'])} > 512)")
-        elif len(request.POST['edit_code']) < 1:
-            error_messages.append(f"edit code is too short ({len(request.POST['edit_code'])} < 1)")
-        if Paste.objects.filter(url_name=paste_url).exists():
-            error_messages.append(f"such url is already taken")
-        try: validate_slug(paste_url)  # NOQA E702
-        except ValidationError:
-            error_messages.append("url must only contain letters, numbers, hyphens and underscores")
+        error_messages = validate_create(
+            request.POST, content, paste_url, Paste.objects.filter(url_name=paste_url).exists()
+        )
         if error_messages:
             return render(request, "myapp/create.html", {
                 'content': content,
                 'paste_url': request.POST['paste_url'],
+                'expires_in': request.POST.get('expires_in', ""),
                 'error_messages': error_messages
             })
 
-        edit_code = hash_sha512(request.POST['edit_code'])
-
         # create the paste
-        compiled = compile_md(content)
-
-        creation_date = datetime.today()
-        paste = Paste(
-            content=content,
-            url_name=paste_url,
-            edit_code=edit_code,
-            compiled=compiled,
-            creation_date=creation_date,
-            edited_date=creation_date
-        )
+        paste = new_paste(request.POST, paste_url)
 
-        paste.save()
+        # pastes which someone else already pasted aren't compiled again
+        paste.save_content(content)
 
         # redirect user to the `view` page
         return HttpResponseRedirect(reverse("myapp:view", args=(paste_url,)))
 
 
+@admitted
 def edit(request, paste_url: str):
-    paste = get_object_or_404(Paste, url_name=paste_url)
     if not request.POST:  # if it is just viewing the page
+        content = Paste.objects.unexpired().filter(url_name=paste_url).values_list('blob__content', flat=True).first()
+        if content is None:
+            raise Http404
         return render(request, "myapp/edit.html", {
-            'new_content': paste.content,
+            'new_content': content,
             'current_url': paste_url
         })
     else:
-        # prepare
-        new_content = request.POST['new_content'].strip()
-        new_paste_url = request.POST['new_paste_url'].strip()
+        paste = get_object_or_404(Paste.objects.unexpired(), url_name=paste_url)
 
-        entered_edit_code = hash_sha512(request.POST['edit_code'])
+        # prepare
+        new_content, new_paste_url = prepare_edit(request.POST)
 
         # validate
-        error_messages = []
-        if entered_edit_code != paste.edit_code:
-            error_messages.append(f"invalid edit code")
-        if len(new_content) > 262144:
-            error_messages.append(f"new contents are too long ({len(new_content)} > 262144)")
-        elif len(new_content) < 1:
-            error_messages.append(f"new contents are too short ({len(new_content)} < 1)")
-        if len(new_paste_url) > 256:
-            error_messages.append(f"new paste url is too long ({len(new_paste_url)} > 256)")
-        if len(request.POST['new_edit_code']) > 512:
-            error_messages.append(f"new edit code is too long ({len(request.POST['new_edit_code'])} > 512)")
-        if new_paste_url and Paste.objects.filter(url_name=new_paste_url).exists():
-            error_messages.append(f"such new url is already taken")
-        if new_paste_url:
-            try:
-                validate_slug(new_paste_url)
-            except ValidationError:
-                error_messages.append("new url must only contain letters, numbers, hyphens and underscores")
+        error_messages = validate_edit(
+            request.POST, paste, new_content, new_paste_url,
+            bool(new_paste_url) and Paste.objects.filter(url_name=new_paste_url).exists()
+        )
         if error_messages:
             return render(request, "myapp/edit.html", {
                 'new_content': new_content,
@@ -133,30 +197,45 @@ def edit(request, paste_url: str):
             })
 
         # edit the paste
-        paste.content = new_content
-        if new_paste_url:
-            paste.url_name = new_paste_url
-        if request.POST['new_edit_code']:
-            paste.edit_code = hash_sha512(request.POST['new_edit_code'])
-        paste.edited_date = datetime.today()
+        apply_edit(request.POST, paste, new_paste_url)
 
-        paste.compiled = compile_md(escape(new_content))
+        paste.save_content(new_content)
 
-        paste.save()
+        edited_pages = get_edited_pages(paste_url, paste.url_name)
+        page_cache.invalidate(*edited_pages)
+        if settings.DB_REPLICAS:
+            page_cache.invalidate_later(settings.DB_REPLICA_LAG, *edited_pages)
 
         # redirect user to the `view` page
         return HttpResponseRedirect(reverse("myapp:view", args=(new_paste_url if new_paste_url else paste_url,)))
 
 
+# newest pastes with every word of `q` in them, see `PASTE_SEARCH_ENDPOINT`
+def search_pastes(request):
+    if not settings.PASTE_SEARCH_ENDPOINT:
+        raise Http404
+
+    query, before = get_search_params(request)
+    ids = search.search(router.db_for_read(Paste), query, before, SEARCH_PAGE_SIZE + 1)
+    return search_response(ids, list(
+        Paste.objects.unexpired().filter(pk__in=ids).values_list('pk', 'url_name', 'creation_date', 'edited_date')
+    ))
+
+
+# histograms from `REQUEST_TIMING`, for prometheus
+def metrics(request):
+    return HttpResponse(request_metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 # error page handlers
 
 def page_not_found(request, exception=None):
-    return render(request, "myapp/error.html", {'error_code': 404})
+    return error_page(request, 404)
 
 
 def server_error(request, exception=None):
-    return render(request, "myapp/error.html", {'error_code': 500})
+    return error_page(request, 500)
 
 
 def bad_request(request, exception=None):
-    return render(request, "myapp/error.html", {'error_code': 400})
+    return error_page(request, 400)
@@ -12,14 +12,23 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 import os
 from pathlib import Path
 
+from django.core.exceptions import ImproperlyConfigured
+
 from myapp.modules.utils import hash_sha512
 
-if not os.path.isfile(".env"):
-    from django.core.management.utils import get_random_secret_key
-    with open(".env", 'w') as f:
-        f.write(f"SECRET_KEY=django-insecure-{get_random_secret_key()}")
+# `development` makes up a secret key and has the admin and live reloading, `production`
+# only has what serving pastes needs and takes everything from the environment.
+# it can't be set in `.env`, as `.env` is only read in development
+SETTINGS_PROFILE = os.environ.get('SETTINGS_PROFILE', "development")
+PRODUCTION = SETTINGS_PROFILE == "production"
+
+if not PRODUCTION:
+    if not os.path.isfile(".env"):
+        from django.core.management.utils import get_random_secret_key
+        with open(".env", 'w') as f:
+            f.write(f"SECRET_KEY=django-insecure-{get_random_secret_key()}")
 
-import dotenv; dotenv.load_dotenv(".env")  # NOQA E702
+    import dotenv; dotenv.load_dotenv(".env")  # NOQA E702
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -30,6 +39,8 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.environ.get('SECRET_KEY')
+if not SECRET_KEY:
+    raise ImproperlyConfigured("SECRET_KEY has to be set in the environment")
 HASH_SALT = hash_sha512(SECRET_KEY, False)
 
 # SECURITY WARNING: don't run with debug turned on in production!
@@ -46,59 +57,150 @@ INTERNAL_IPS = [
 
 TAILWIND_APP_NAME = 'myapp'
 
+# the admin (and the auth, sessions and messages it needs), on by default only in development
+ADMIN = bool(int(os.environ.get('ADMIN', "0" if PRODUCTION else "1")))
+# reloads pages when templates change, which means looking through every html response
+BROWSER_RELOAD = not PRODUCTION
+
 INSTALLED_APPS = [
-    'django.contrib.admin',
-    'django.contrib.auth',
     'django.contrib.contenttypes',
-    'django.contrib.sessions',
-    'django.contrib.messages',
     'django.contrib.staticfiles',
     'tailwind',
     'myapp',
-    'django_browser_reload'
 ]
+if ADMIN:
+    INSTALLED_APPS[:0] = [
+        'django.contrib.admin',
+        'django.contrib.auth',
+        'django.contrib.sessions',
+        'django.contrib.messages',
+    ]
+if BROWSER_RELOAD:
+    INSTALLED_APPS.append('django_browser_reload')
 
 MIDDLEWARE = [
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'myapp.middleware.request_timing_middleware',
+    'myapp.middleware.replica_middleware',
     'django.middleware.security.SecurityMiddleware',
-    'django.contrib.sessions.middleware.SessionMiddleware',
+    *(['django.contrib.sessions.middleware.SessionMiddleware'] if ADMIN else []),
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
-    'django.contrib.messages.middleware.MessageMiddleware',
+    *([
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+        'django.contrib.messages.middleware.MessageMiddleware',
+    ] if ADMIN else []),
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'django_browser_reload.middleware.BrowserReloadMiddleware'
+    *(['django_browser_reload.middleware.BrowserReloadMiddleware'] if BROWSER_RELOAD else []),
 ]
 
 ROOT_URLCONF = 'opyn.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # django templates, which also count how long rendering takes (see `REQUEST_TIMING`)
+        'BACKEND': 'myapp.modules.timing.TimedTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
+        'APP_DIRS': not PRODUCTION,
         'OPTIONS': {
             'context_processors': [
-                'django.template.context_processors.debug',
+                *(['django.template.context_processors.debug'] if not PRODUCTION else []),
                 'django.template.context_processors.request',
-                'django.contrib.auth.context_processors.auth',
-                'django.contrib.messages.context_processors.messages',
+                *([
+                    'django.contrib.auth.context_processors.auth',
+                    'django.contrib.messages.context_processors.messages',
+                ] if ADMIN else []),
             ],
         },
     },
 ]
 
+if PRODUCTION:
+    # the same loaders django picks by itself, spelled out so templates are never looked at
+    # again after the first time. in development the cache is cleared when a template changes
+    TEMPLATES[0]['OPTIONS']['loaders'] = [
+        ('django.template.loaders.cached.Loader', ['django.template.loaders.app_directories.Loader']),
+    ]
+
 WSGI_APPLICATION = 'opyn.wsgi.application'
 
 
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# `development` is a plain sqlite file, `production` is the same file tuned for
+# readers not waiting on writers and `postgres` (needs psycopg) is for more than one machine
+DATABASE_PROFILE = os.environ.get('DATABASE_PROFILE', "development")
+
+if DATABASE_PROFILE == "postgres":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('DB_NAME', "opyn"),
+            'USER': os.environ.get('DB_USER', ""),
+            'PASSWORD': os.environ.get('DB_PASSWORD', ""),
+            'HOST': os.environ.get('DB_HOST', ""),
+            'PORT': os.environ.get('DB_PORT', ""),
+            'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', "600")),
+            'CONN_HEALTH_CHECKS': True,
+        }
+    }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get('DB_NAME', BASE_DIR / 'db.sqlite3'),
+        }
     }
+
+if DATABASE_PROFILE == "production":
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get('DB_CONN_MAX_AGE', "600"))
+
+# read only copies of the database (comma separated sqlite files, or postgres hosts) which page
+# reads are spread over, `default` stays the primary every write goes to. `manage.py replicate`
+# keeps sqlite ones up to date, which is mostly useful for trying this out on one machine
+DB_REPLICAS = [replica for replica in os.environ.get('DB_REPLICAS', "").split(",") if replica]
+# seconds the replicas can be behind the primary. clients read from the primary for that long
+# after they wrote anything, and edited pages are taken out of the page cache again after it
+DB_REPLICA_LAG = int(os.environ.get('DB_REPLICA_LAG', "5"))
+
+for i, replica in enumerate(DB_REPLICAS):
+    DATABASES[f'replica_{i}'] = {
+        **DATABASES['default'],
+        'HOST' if DATABASE_PROFILE == "postgres" else 'NAME': replica,
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['myapp.modules.db.ReplicaRouter'] if DB_REPLICAS else []
+
+# set on every new sqlite connection (see `myapp.modules.db`)
+SQLITE_PRAGMAS = {
+    # readers don't block writers and writers don't block readers
+    'journal_mode': "WAL",
+    # with WAL this can only lose the last transactions on a power loss, never corrupt anything
+    'synchronous': "NORMAL",
+    'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', "5000")),  # ms
+    'mmap_size': int(os.environ.get('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024))),  # bytes
+    'cache_size': -int(os.environ.get('SQLITE_CACHE_SIZE', str(64 * 1024))),  # KiB
+    'temp_store': "MEMORY",
+} if DATABASE_PROFILE == "production" else {}
+
+
+# Caches
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # compiled groups of blocks of pastes, in every process. bounded by the
+    # characters of html it holds, as groups of the same size can compile to very different sizes
+    'blocks': {
+        'BACKEND': 'myapp.modules.pagecache.ByteLRUCache',
+        'LOCATION': 'blocks',
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_BYTES': int(os.environ.get('COMPILE_BLOCK_CACHE_BYTES', str(16 * 1024 * 1024)))},
+    },
 }
 
 
@@ -139,6 +241,72 @@ USE_TZ = True
 STATIC_URL = '/static/'
 STATIC_ROOT = BASE_DIR / 'static'
 
+# Pastes
+
+# stream `view` and `raw` pages out in chunks instead of rendering them in one go
+STREAM_PASTES = bool(int(os.environ.get('STREAM_PASTES', "0")))
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', "16384"))
+
+# `Cache-Control` of `view` and `raw` pages, every paste can be edited so by default
+# caches (and proxies in front of us) have to check if it is still the same first
+PASTE_CACHE_CONTROL = {
+    'public': True,
+    'max_age': int(os.environ.get('PASTE_MAX_AGE', "0")),
+    's_maxage': int(os.environ.get('PASTE_SHARED_MAX_AGE', "0")),
+}
+
+# how many bytes of rendered `view` and `raw` pages each process keeps (0 turns it off)
+PASTE_PAGE_CACHE_BYTES = int(os.environ.get('PASTE_PAGE_CACHE_BYTES', str(32 * 1024 * 1024)))
+# alias in `CACHES` of a cache shared by every process, so edits invalidate pages everywhere
+PASTE_PAGE_CACHE_BACKEND = os.environ.get('PASTE_PAGE_CACHE_BACKEND') or None
+PASTE_PAGE_CACHE_TIMEOUT = int(os.environ.get('PASTE_PAGE_CACHE_TIMEOUT', "3600"))
+
+# serve pastes with async views, only worth it when running under ASGI (`opyn.asgi`)
+ASYNC_VIEWS = bool(int(os.environ.get('ASYNC_VIEWS', "0")))
+# how many small pastes async views compile at once
+COMPILE_THREADS = int(os.environ.get('COMPILE_THREADS', "4"))
+# pastes longer than this are compiled in separate processes
+COMPILE_INLINE_LIMIT = int(os.environ.get('COMPILE_INLINE_LIMIT', "32768"))
+COMPILE_PROCESSES = int(os.environ.get('COMPILE_PROCESSES', "2"))
+# seconds a paste gets to compile before it is shown as plain text (until `recompile_pastes --only-stale`)
+COMPILE_TIMEOUT = float(os.environ.get('COMPILE_TIMEOUT', "5"))
+# alias in `CACHES` where compiled blocks of pastes are kept, so an edit only
+# compiles the blocks which changed (empty turns it off)
+COMPILE_BLOCK_CACHE = os.environ.get('COMPILE_BLOCK_CACHE', "blocks")
+
+# how `Paste.content` is stored: `zlib`, `zstd` (needs `zstandard`) or `none`.
+# `Paste.compiled` is always deflated, so it can be sent out in gzip responses as is
+PASTE_COMPRESSION = os.environ.get('PASTE_COMPRESSION', "zlib")
+PASTE_COMPRESSION_LEVEL = int(os.environ.get('PASTE_COMPRESSION_LEVEL', "6"))
+# send `view` pages gzipped to clients which accept that, with the stored `Paste.compiled`
+# put into the gzip body without decompressing it
+SERVE_GZIP_PASTES = bool(int(os.environ.get('SERVE_GZIP_PASTES', "1")))
+
+# keep an sqlite fts5 index of every paste, for the admin and `search`. `manage.py index_pastes`
+# adds the ones from before. does nothing on postgres
+PASTE_SEARCH = bool(int(os.environ.get('PASTE_SEARCH', "1")))
+# serve `search`, which lists pastes nobody might have linked anywhere, so it is off by default
+PASTE_SEARCH_ENDPOINT = bool(int(os.environ.get('PASTE_SEARCH_ENDPOINT', "0")))
+
+# put db, compile_md, hash_sha512 and render times of every request into a `Server-Timing`
+# header and into histograms per url name, served at `status/metrics`
+REQUEST_TIMING = bool(int(os.environ.get('REQUEST_TIMING', "1")))
+
+# Admission control
+
+# `create`/`edit` posts every client can make, `POST_BURST` at once and then `POST_RATE_LIMIT` a
+# second, more get a 429. off (0) by default, as behind a proxy every client has the same address
+POST_RATE_LIMIT = float(os.environ.get('POST_RATE_LIMIT', "0"))
+POST_BURST = int(os.environ.get('POST_BURST', "10"))
+# header with the address of clients when behind a proxy, like `X-Forwarded-For` (its last address is used)
+CLIENT_IP_HEADER = os.environ.get('CLIENT_IP_HEADER', "")
+# how many `create`/`edit` posts every process works on at once (0 turns it off), so they can't take
+# every thread away from pages. it is per process, so it only does something with threaded or ASGI
+# workers. sync views send the others a 429 right away, async ones wait for up to `POST_QUEUE_TIMEOUT`
+# seconds and then get a 503. both tell clients to retry after `POST_QUEUE_TIMEOUT`
+POST_CONCURRENCY = int(os.environ.get('POST_CONCURRENCY', "2"))
+POST_QUEUE_TIMEOUT = float(os.environ.get('POST_QUEUE_TIMEOUT', "2"))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
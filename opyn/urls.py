@@ -14,15 +14,20 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
-from django.contrib import admin
+from django.conf import settings
 from django.urls import path, include
 
 urlpatterns = [
     path('', include('myapp.urls')),
-    path('admin/', admin.site.urls),
-    path("__reload__/", include("django_browser_reload.urls"))
 ]
 
+if settings.ADMIN:
+    from django.contrib import admin
+    urlpatterns.append(path('admin/', admin.site.urls))
+
+if settings.BROWSER_RELOAD:
+    urlpatterns.append(path("__reload__/", include("django_browser_reload.urls")))
+
 handler404 = "myapp.views.page_not_found"
 handler500 = "myapp.views.server_error"
 handler400 = "myapp.views.bad_request"